@@ -32,7 +32,30 @@ import math
 import re
 import sys
 import time
-import urllib
+# urllib.unquote, without urllib itself: urllib imports socket and ssl, which take
+# longer to import than the rest of this module.
+from urlparse import unquote
+
+# The characters urllib.quote leaves alone in deltas and patches, and what it
+# turns every byte into.
+_QUOTE_SAFE = ("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_.-"
+               "!~*'();/?:@&=+$,# ")
+_QUOTED = dict((chr(i), chr(i) if chr(i) in _QUOTE_SAFE else "%%%02X" % i)
+               for i in xrange(256))
+
+
+def _quote(data):
+  """Quotes a byte string like urllib.quote(data, "!~*'();/?:@&=+$,# ").
+
+  Args:
+    data: Byte string to quote.
+
+  Returns:
+    Quoted string.
+  """
+  if not data.rstrip(_QUOTE_SAFE):
+    return data
+  return "".join(map(_QUOTED.__getitem__, data))
 
 class diff_match_patch:
   """Class containing the diff, match and patch methods.
@@ -47,6 +70,10 @@ class diff_match_patch:
 
     # Number of seconds to map a diff before giving up (0 for infinity).
     self.Diff_Timeout = 1.0
+    # Number of edit steps to map a diff before giving up (0 for infinity).
+    # Unlike Diff_Timeout, the result doesn't depend on the speed of the
+    # machine.  Set Diff_Timeout to 0 to only use this limit.
+    self.Diff_MaxSteps = 0
     # Cost of an empty edit operation in terms of edit characters.
     self.Diff_EditCost = 4
     # At what point is no match declared (0.0 = perfection, 1.0 = very loose).
@@ -90,6 +117,7 @@ class diff_match_patch:
         Defaults to true, which does a faster, slightly less optimal diff.
       deadline: Optional time when the diff should be complete by.  Used
         internally for recursive calls.  Users should set DiffTimeout instead.
+        sys.maxint means no deadline.
 
     Returns:
       Array of changes.
@@ -272,6 +300,11 @@ class diff_match_patch:
     text1_length = len(text1)
     text2_length = len(text2)
     max_d = (text1_length + text2_length + 1) // 2
+    # Only consult the clock if there is a deadline.
+    check_deadline = deadline != sys.maxint
+    max_steps = max_d
+    if self.Diff_MaxSteps > 0:
+      max_steps = min(max_d, self.Diff_MaxSteps)
     v_offset = max_d
     v_length = 2 * max_d
     v1 = [-1] * v_length
@@ -287,9 +320,9 @@ class diff_match_patch:
     k1end = 0
     k2start = 0
     k2end = 0
-    for d in xrange(max_d):
+    for d in xrange(max_steps):
       # Bail out if deadline is reached.
-      if time.time() > deadline:
+      if check_deadline and time.time() > deadline:
         break
 
       # Walk the front path one step.
@@ -352,8 +385,8 @@ class diff_match_patch:
               # Overlap detected.
               return self.diff_bisectSplit(text1, text2, x1, y1, deadline)
 
-    # Diff took too long and hit the deadline or
-    # number of diffs equals number of characters, no commonality at all.
+    # Diff took too long and hit the deadline or the maximum number of steps,
+    # or number of diffs equals number of characters, no commonality at all.
     return [(self.DIFF_DELETE, text1), (self.DIFF_INSERT, text2)]
 
   def diff_bisectSplit(self, text1, text2, x, y, deadline):
@@ -381,6 +414,245 @@ class diff_match_patch:
 
     return diffs + diffsb
 
+  def diff_banded(self, text1, text2, max_edits):
+    """Find the differences between two texts that differ by only a few
+    edits.  Faster than diff_main for short, similar texts, since it only
+    explores the diagonals within max_edits of the main diagonal.
+    See Myers 1986 paper: An O(ND) Difference Algorithm and Its Variations.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+      max_edits: Maximum number of inserted and deleted characters.  A
+        substituted character counts as two.
+
+    Returns:
+      Array of diff tuples with the fewest edits, or None if the texts
+      differ by more than max_edits.  Texts of which one is inside the
+      other are always diffed.
+    """
+    return self.diff_trimmed(text1, text2,
+        lambda text1, text2: self.diff_bandedCompute(text1, text2, max_edits))
+
+  def diff_trimmed(self, text1, text2, compute):
+    """Trim off the common prefix and suffix of two texts, and diff the rest
+    with compute.  Texts of which one is inside the other are diffed
+    directly.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+      compute: Function that diffs two texts without a common prefix or
+        suffix, and returns an array of diff tuples or None.
+
+    Returns:
+      Array of diff tuples, or None if compute returned None.
+    """
+    # Check for equality (speedup).
+    if text1 == text2:
+      if text1:
+        return [(self.DIFF_EQUAL, text1)]
+      return []
+
+    # Trim off common prefix and suffix (speedup).
+    commonlength = self.diff_commonPrefix(text1, text2)
+    commonprefix = text1[:commonlength]
+    text1 = text1[commonlength:]
+    text2 = text2[commonlength:]
+    commonlength = self.diff_commonSuffix(text1, text2)
+    if commonlength == 0:
+      commonsuffix = ""
+    else:
+      commonsuffix = text1[-commonlength:]
+      text1 = text1[:-commonlength]
+      text2 = text2[:-commonlength]
+
+    if not text1 or not text2 or text1 in text2 or text2 in text1:
+      # Just add or delete some text (speedup).
+      diffs = self.diff_compute(text1, text2, False, sys.maxint)
+    else:
+      diffs = compute(text1, text2)
+      if diffs is None:
+        return None
+
+    # Restore the prefix and suffix.
+    if commonprefix:
+      diffs[:0] = [(self.DIFF_EQUAL, commonprefix)]
+    if commonsuffix:
+      diffs.append((self.DIFF_EQUAL, commonsuffix))
+    self.diff_cleanupMerge(diffs)
+    return diffs
+
+  def diff_bandedCompute(self, text1, text2, max_edits):
+    """Find the differences between two texts within max_edits edits.
+      Assumes that the texts do not have any common prefix or suffix.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+      max_edits: Maximum number of inserted and deleted characters.
+
+    Returns:
+      Array of diff tuples, or None if the texts differ by more than
+      max_edits.
+    """
+    text1_length = len(text1)
+    text2_length = len(text2)
+    if abs(text1_length - text2_length) > max_edits:
+      return None
+    # No diff takes more edits than deleting text1 and inserting text2.
+    max_edits = min(max_edits, text1_length + text2_length)
+
+    # v[v_offset + k] is the furthest x reached on diagonal k.  Keep a copy
+    # of v for every d, to trace the path back once the end is reached.
+    v_offset = max_edits + 1
+    v = [-1] * (2 * max_edits + 3)
+    v[v_offset + 1] = 0
+    trace = []
+    end = None
+    for d in xrange(max_edits + 1):
+      trace.append(v[:])
+      for k in xrange(-d, d + 1, 2):
+        k_offset = v_offset + k
+        if k == -d or (k != d and v[k_offset - 1] < v[k_offset + 1]):
+          x = v[k_offset + 1]
+        else:
+          x = v[k_offset - 1] + 1
+        y = x - k
+        while (x < text1_length and y < text2_length and
+               text1[x] == text2[y]):
+          x += 1
+          y += 1
+        v[k_offset] = x
+        if x >= text1_length and y >= text2_length:
+          end = d
+          break
+      if end is not None:
+        break
+    if end is None:
+      return None
+
+    # Walk back from the end, one edit at a time.
+    diffs = []
+    x = text1_length
+    y = text2_length
+    for d in xrange(end, 0, -1):
+      v = trace[d]
+      k = x - y
+      k_offset = v_offset + k
+      if k == -d or (k != d and v[k_offset - 1] < v[k_offset + 1]):
+        # Insertion.
+        x_start = v[k_offset + 1]
+        y_start = x_start - k
+        edit = (self.DIFF_INSERT, text2[y_start - 1])
+      else:
+        # Deletion.
+        x_start = v[k_offset - 1] + 1
+        y_start = x_start - k
+        edit = (self.DIFF_DELETE, text1[x_start - 1])
+      if x > x_start:
+        diffs.append((self.DIFF_EQUAL, text1[x_start:x]))
+      diffs.append(edit)
+      x = x_start - (edit[0] == self.DIFF_DELETE)
+      y = y_start - (edit[0] == self.DIFF_INSERT)
+    if x > 0:
+      diffs.append((self.DIFF_EQUAL, text1[:x]))
+    diffs.reverse()
+    return diffs
+
+  def diff_bitParallel(self, text1, text2):
+    """Find the differences between two texts with the fewest inserted,
+    deleted and substituted characters.  Computes a column of the edit
+    distance matrix at a time, with each column packed into an integer.
+    Fast for short texts over a small alphabet, such as reads of DNA.
+    See Myers 1999 paper: A Fast Bit-Vector Algorithm for Approximate String
+    Matching Based on Dynamic Programming, and Hyyro 2004: A Note on
+    Bit-Parallel Alignment Computation.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+
+    Returns:
+      Array of diff tuples.
+    """
+    return self.diff_trimmed(text1, text2, self.diff_bitParallelCompute)
+
+  def diff_bitParallelCompute(self, text1, text2):
+    """Find the differences between two texts with the fewest edits.
+      Assumes that the texts do not have any common prefix or suffix.
+
+    Args:
+      text1: Old string to be diffed.
+      text2: New string to be diffed.
+
+    Returns:
+      Array of diff tuples.
+    """
+    text1_length = len(text1)
+    # Bit i of peq[c] is set if text1[i] is c.  Only the characters that
+    # occur in text1 get a mask, the rest never match.
+    peq = {}
+    for i in xrange(text1_length):
+      peq[text1[i]] = peq.get(text1[i], 0) | (1 << i)
+    # Bit i of pv (mv) is set if the distance to text1[:i + 1] is one more
+    # (less) than the distance to text1[:i].  In the first column, before
+    # any of text2, all of them are one more.  The bits above text1_length
+    # are never looked at, so they aren't masked off.
+    pv = -1
+    mv = 0
+    # Keep the vertical and horizontal increases of every column, to walk
+    # back through the matrix afterwards.
+    columns = [(pv, 0)]
+    for c in text2:
+      eq = peq.get(c, 0)
+      xv = eq | mv
+      xh = (((eq & pv) + pv) ^ pv) | eq
+      ph = mv | ~(xh | pv)
+      mh = pv & xh
+      # The distance to the empty prefix of text1 grows by one per column.
+      ph_shifted = (ph << 1) | 1
+      mh_shifted = mh << 1
+      pv = mh_shifted | ~(xv | ph_shifted)
+      mv = ph_shifted & xv
+      columns.append((pv, ph))
+
+    # Walk back from the bottom right corner.  Row i is text1[:i], column j
+    # is text2[:j].
+    diffs = []
+    i = text1_length
+    j = len(text2)
+    while i > 0 and j > 0:
+      if text1[i - 1] == text2[j - 1]:
+        end = i
+        while i > 0 and j > 0 and text1[i - 1] == text2[j - 1]:
+          i -= 1
+          j -= 1
+        diffs.append((self.DIFF_EQUAL, text1[i:end]))
+        continue
+      bit = 1 << (i - 1)
+      (pv, ph) = columns[j]
+      if pv & bit:
+        # The cell above is one less: text1[i - 1] was deleted.
+        diffs.append((self.DIFF_DELETE, text1[i - 1]))
+        i -= 1
+      elif ph & bit:
+        # The cell to the left is one less: text2[j - 1] was inserted.
+        diffs.append((self.DIFF_INSERT, text2[j - 1]))
+        j -= 1
+      else:
+        # Substitution.
+        diffs.append((self.DIFF_INSERT, text2[j - 1]))
+        diffs.append((self.DIFF_DELETE, text1[i - 1]))
+        i -= 1
+        j -= 1
+    if i > 0:
+      diffs.append((self.DIFF_DELETE, text1[:i]))
+    if j > 0:
+      diffs.append((self.DIFF_INSERT, text2[:j]))
+    diffs.reverse()
+    return diffs
+
   def diff_linesToChars(self, text1, text2):
     """Split two texts into an array of strings.  Reduce the texts to a string
     of hashes where each Unicode character represents one line.
@@ -564,7 +836,7 @@ class diff_match_patch:
       the prefix of text2, the suffix of text2 and the common middle.  Or None
       if there was no match.
     """
-    if self.Diff_Timeout <= 0:
+    if self.Diff_Timeout <= 0 and self.Diff_MaxSteps <= 0:
       # Don't risk returning a non-optimal diff if we have unlimited time.
       return None
     if len(text1) > len(text2):
@@ -1152,7 +1424,7 @@ class diff_match_patch:
       if op == self.DIFF_INSERT:
         # High ascii will raise UnicodeDecodeError.  Use Unicode instead.
         data = data.encode("utf-8")
-        text.append("+" + urllib.quote(data, "!~*'();/?:@&=+$,# "))
+        text.append("+" + _quote(data))
       elif op == self.DIFF_DELETE:
         text.append("-%d" % len(data))
       elif op == self.DIFF_EQUAL:
@@ -1188,7 +1460,7 @@ class diff_match_patch:
       # operation of this token (delete, insert, equality).
       param = token[1:]
       if token[0] == "+":
-        param = urllib.unquote(param).decode("utf-8")
+        param = unquote(param).decode("utf-8")
         diffs.append((self.DIFF_INSERT, param))
       elif token[0] == "-" or token[0] == "=":
         try:
@@ -1847,7 +2119,7 @@ class diff_match_patch:
           sign = text[0][0]
         else:
           sign = ''
-        line = urllib.unquote(text[0][1:])
+        line = unquote(text[0][1:])
         line = line.decode("utf-8")
         if sign == '+':
           # Insertion.
@@ -1915,5 +2187,5 @@ class patch_obj:
         text.append(" ")
       # High ascii will raise UnicodeDecodeError.  Use Unicode instead.
       data = data.encode("utf-8")
-      text.append(urllib.quote(data, "!~*'();/?:@&=+$,# ") + "\n")
+      text.append(_quote(data) + "\n")
     return "".join(text)
@@ -0,0 +1,162 @@
+#!/usr/bin/python2.4
+
+"""Speed tests for diff_match_patch.py on fastq-shaped inputs.
+
+Times the diff functions that fq_delta calls for every line, on read-length
+strings (50-300 characters) with the kinds of edits fastq processing tools
+make, and on a few pathological cases.  Every timing is compared against a
+threshold, so changes to the diff engine can be judged on fastq workloads
+instead of prose.
+
+Usage: diff_match_patch_benchmark.py [scale]
+  scale: multiply all thresholds by this factor, for slower machines.
+The exit status is 1 if any timing exceeds its threshold.
+"""
+
+import random
+import sys
+import timeit
+import diff_match_patch as dmp_module
+
+
+def make_cases():
+  """Build the (name, text1, text2) cases.  Seeded, so always the same."""
+  rng = random.Random(1)
+
+  def read(length):
+    return "".join(rng.choice("ACGT") for x in xrange(length))
+
+  def quality(length):
+    return "".join(chr(33 + rng.randint(2, 40)) for x in xrange(length))
+
+  cases = []
+  for length in (50, 100, 300):
+    text = read(length)
+    cases.append(("identical_%d" % length, text, text))
+    middle = length // 2
+    base = "A" if text[middle] != "A" else "C"
+    snp = text[:middle] + base + text[middle + 1:]
+    cases.append(("snp_%d" % length, text, snp))
+    cases.append(("trim_%d" % length, text, text[3:length - length // 4]))
+    masked = "".join(c if rng.random() > 0.1 else "N" for c in text)
+    cases.append(("masked_%d" % length, text, masked))
+    third = length // 3
+    indel = (text[:third] + "GAT" + text[third:2 * third] +
+             text[2 * third + 2:])
+    cases.append(("indel_%d" % length, text, indel))
+    qual = quality(length)
+    cases.append(("quality_trim_%d" % length, qual,
+                  qual[:length - length // 5]))
+    # Pathological cases.
+    cases.append(("unrelated_%d" % length, text, read(length)))
+    cases.append(("homopolymer_%d" % length, "A" * length,
+                  "A" * (length // 2) + "C" + "A" * (length // 2 - 1)))
+    cases.append(("phred_shift_%d" % length, qual,
+                  "".join(chr(ord(c) + 31) for c in qual)))
+  return cases
+
+
+# Maximum microseconds per call at a read length of 100, per function and
+# kind of case.  Longer reads get a proportionally higher threshold, and
+# quadratically higher for the cases without any common substrings.
+THRESHOLDS = {
+    "diff_main": {"identical": 25, "snp": 40, "trim": 30, "masked": 2400,
+                  "indel": 110, "quality_trim": 25, "unrelated": 13200,
+                  "homopolymer": 40, "phred_shift": 32400},
+    "diff_bisect": {"identical": 110, "snp": 100, "trim": 720, "masked": 2400,
+                    "indel": 120, "quality_trim": 420, "unrelated": 13100,
+                    "homopolymer": 180, "phred_shift": 31700},
+    "diff_banded": {"identical": 25, "snp": 40, "trim": 30, "masked": 600,
+                    "indel": 130, "quality_trim": 25, "unrelated": 560,
+                    "homopolymer": 40, "phred_shift": 460},
+    "diff_bitParallel": {"identical": 25, "snp": 40, "trim": 30,
+                         "masked": 500, "indel": 200, "quality_trim": 25,
+                         "unrelated": 900, "homopolymer": 40,
+                         "phred_shift": 900},
+    "diff_halfMatch": {"identical": 40, "snp": 30, "trim": 30, "masked": 25,
+                       "indel": 25, "quality_trim": 30, "unrelated": 25,
+                       "homopolymer": 1100, "phred_shift": 25},
+    "diff_cleanupMerge": {"identical": 25, "snp": 25, "trim": 25,
+                          "masked": 120, "indel": 25, "quality_trim": 25,
+                          "unrelated": 240, "homopolymer": 25,
+                          "phred_shift": 80},
+    "diff_toDelta": {"identical": 25, "snp": 25, "trim": 25, "masked": 110,
+                     "indel": 25, "quality_trim": 25, "unrelated": 270,
+                     "homopolymer": 25, "phred_shift": 120},
+    "diff_fromDelta": {"identical": 25, "snp": 25, "trim": 25, "masked": 150,
+                       "indel": 30, "quality_trim": 25, "unrelated": 250,
+                       "homopolymer": 25, "phred_shift": 160},
+}
+QUADRATIC = ("unrelated", "phred_shift")
+# The edit bound of diff_banded.
+MAX_EDITS = 32
+
+
+def threshold(function_name, name):
+  """Return the threshold in microseconds for a function and case name."""
+  (kind, length) = name.rsplit("_", 1)
+  factor = max(1.0, int(length) / 100.0)
+  if kind in QUADRATIC and function_name in ("diff_main", "diff_bisect"):
+    factor **= 2
+  return THRESHOLDS[function_name][kind] * factor
+
+
+def best_time(function, min_time=0.02, repeat=3):
+  """Return the best time in microseconds of a single call to function."""
+  timer = timeit.default_timer
+  number = 1
+  while True:
+    start = timer()
+    for x in xrange(number):
+      function()
+    if timer() - start >= min_time:
+      break
+    number *= 2
+  best = None
+  for x in xrange(repeat):
+    start = timer()
+    for y in xrange(number):
+      function()
+    elapsed = (timer() - start) / number
+    if best is None or elapsed < best:
+      best = elapsed
+  return best * 1e6
+
+
+def run(scale=1.0, out=sys.stdout):
+  """Time every function on every case.  Return the number of failures."""
+  dmp = dmp_module.diff_match_patch()
+  failures = 0
+  out.write("%-18s %-20s %12s %12s\n" %
+            ("function", "case", "usec/call", "threshold"))
+  for (name, text1, text2) in make_cases():
+    diffs = dmp.diff_main(text1, text2)
+    delta = dmp.diff_toDelta(diffs)
+    functions = [
+        ("diff_main", lambda: dmp.diff_main(text1, text2)),
+        ("diff_bisect", lambda: dmp.diff_bisect(text1, text2, sys.maxint)),
+        ("diff_banded", lambda: dmp.diff_banded(text1, text2, MAX_EDITS)),
+        ("diff_bitParallel", lambda: dmp.diff_bitParallel(text1, text2)),
+        ("diff_halfMatch", lambda: dmp.diff_halfMatch(text1, text2)),
+        ("diff_cleanupMerge", lambda: dmp.diff_cleanupMerge(diffs[:])),
+        ("diff_toDelta", lambda: dmp.diff_toDelta(diffs)),
+        ("diff_fromDelta", lambda: dmp.diff_fromDelta(text1, delta)),
+    ]
+    for (function_name, function) in functions:
+      usec = best_time(function)
+      limit = threshold(function_name, name) * scale
+      status = ""
+      if usec > limit:
+        status = "SLOW"
+        failures += 1
+      out.write("%-18s %-20s %12.1f %12.0f %s\n" %
+                (function_name, name, usec, limit, status))
+  return failures
+
+
+if __name__ == "__main__":
+  scale = 1.0
+  if len(sys.argv) > 1:
+    scale = float(sys.argv[1])
+  if run(scale):
+    sys.exit(1)
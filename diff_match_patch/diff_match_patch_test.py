@@ -444,6 +444,60 @@ class DiffTest(DiffMatchPatchTest):
     # Levenshtein with middle equality.
     self.assertEquals(7, self.dmp.diff_levenshtein([(self.dmp.DIFF_DELETE, "abc"), (self.dmp.DIFF_EQUAL, "xyz"), (self.dmp.DIFF_INSERT, "1234")]))
 
+  def testDiffBanded(self):
+    # Trivial cases.
+    self.assertEquals([], self.dmp.diff_banded("", "", 0))
+    self.assertEquals([(self.dmp.DIFF_EQUAL, "ACGT")], self.dmp.diff_banded("ACGT", "ACGT", 0))
+
+    # Substitution.
+    self.assertEquals([(self.dmp.DIFF_EQUAL, "AC"), (self.dmp.DIFF_DELETE, "G"), (self.dmp.DIFF_INSERT, "N"), (self.dmp.DIFF_EQUAL, "TA")], self.dmp.diff_banded("ACGTA", "ACNTA", 2))
+
+    # Insertion and deletion.
+    self.assertEquals([(self.dmp.DIFF_EQUAL, "AC"), (self.dmp.DIFF_INSERT, "GA"), (self.dmp.DIFF_EQUAL, "TTCA"), (self.dmp.DIFF_DELETE, "G"), (self.dmp.DIFF_EQUAL, "T")], self.dmp.diff_banded("ACTTCAGT", "ACGATTCAT", 3))
+
+    # Trims.
+    self.assertEquals([(self.dmp.DIFF_DELETE, "AC"), (self.dmp.DIFF_EQUAL, "GTACGT"), (self.dmp.DIFF_DELETE, "TTT")], self.dmp.diff_banded("ACGTACGTTTT", "GTACGT", 5))
+
+    # Trims don't count against max_edits.
+    self.assertEquals([(self.dmp.DIFF_DELETE, "AC"), (self.dmp.DIFF_EQUAL, "GTACGT"), (self.dmp.DIFF_DELETE, "TTT")], self.dmp.diff_banded("ACGTACGTTTT", "GTACGT", 0))
+
+    # More edits than allowed.
+    self.assertEquals(None, self.dmp.diff_banded("ACGTA", "ACNTA", 1))
+    self.assertEquals(None, self.dmp.diff_banded("ACGTACGTTTT", "GTCCGT", 4))
+    self.assertEquals(None, self.dmp.diff_banded("ACGT", "TGCA", 5))
+
+    # Same number of edits as diff_main.
+    a = "CCTACAGTAGCCACACAGATCGCGGTGACGGCTCAGGATGATCGATGGCTACCGCAG"
+    b = "CCTACAGNAGCCACACAGATCGGGTGACGGCTCAGGATGATCGAATGGCTACCGCNG"
+    diffs = self.dmp.diff_banded(a, b, 10)
+    self.assertEquals((a, b), self.diff_rebuildtexts(diffs))
+    self.assertEquals(self.dmp.diff_levenshtein(self.dmp.diff_main(a, b)), self.dmp.diff_levenshtein(diffs))
+
+  def testDiffBitParallel(self):
+    # Trivial cases.
+    self.assertEquals([], self.dmp.diff_bitParallel("", ""))
+    self.assertEquals([(self.dmp.DIFF_EQUAL, "ACGT")], self.dmp.diff_bitParallel("ACGT", "ACGT"))
+    self.assertEquals([(self.dmp.DIFF_INSERT, "ACGT")], self.dmp.diff_bitParallel("", "ACGT"))
+
+    # Substitutions.
+    self.assertEquals([(self.dmp.DIFF_EQUAL, "AC"), (self.dmp.DIFF_DELETE, "G"), (self.dmp.DIFF_INSERT, "N"), (self.dmp.DIFF_EQUAL, "TA"), (self.dmp.DIFF_DELETE, "CG"), (self.dmp.DIFF_INSERT, "NN"), (self.dmp.DIFF_EQUAL, "T")], self.dmp.diff_bitParallel("ACGTACGT", "ACNTANNT"))
+
+    # Insertion and deletion.
+    self.assertEquals([(self.dmp.DIFF_EQUAL, "AC"), (self.dmp.DIFF_INSERT, "GA"), (self.dmp.DIFF_EQUAL, "TTCA"), (self.dmp.DIFF_DELETE, "G"), (self.dmp.DIFF_EQUAL, "T")], self.dmp.diff_bitParallel("ACTTCAGT", "ACGATTCAT"))
+
+    # Trims.
+    self.assertEquals([(self.dmp.DIFF_DELETE, "AC"), (self.dmp.DIFF_EQUAL, "GTACGT"), (self.dmp.DIFF_DELETE, "TTT")], self.dmp.diff_bitParallel("ACGTACGTTTT", "GTACGT"))
+
+    # Nothing in common.
+    self.assertEquals([(self.dmp.DIFF_DELETE, "ACGT"), (self.dmp.DIFF_INSERT, "NNNN")], self.dmp.diff_bitParallel("ACGT", "NNNN"))
+
+    # Texts longer than a machine word, with the fewest edits.
+    a = "CCTACAGTAGCCACACAGATCGCGGTGACGGCTCAGGATGATCGATGGCTACCGCAGTTTAAAGAGCC"
+    b = "CCTACAGNAGCCACACAGATCGGGTGACGGCTCAGGATGATCGAATGGCTACCGCNGTTTAAAGAGCG"
+    diffs = self.dmp.diff_bitParallel(a, b)
+    self.assertEquals((a, b), self.diff_rebuildtexts(diffs))
+    self.assertEquals(5, self.dmp.diff_levenshtein(diffs))
+
   def testDiffBisect(self):
     # Normal.
     a = "cat"
@@ -456,6 +510,12 @@ class DiffTest(DiffMatchPatchTest):
     # Timeout.
     self.assertEquals([(self.dmp.DIFF_DELETE, "cat"), (self.dmp.DIFF_INSERT, "map")], self.dmp.diff_bisect(a, b, 0))
 
+    # Maximum number of steps.
+    self.dmp.Diff_MaxSteps = 2
+    self.assertEquals([(self.dmp.DIFF_DELETE, "cat"), (self.dmp.DIFF_INSERT, "map")], self.dmp.diff_bisect(a, b, sys.maxint))
+    self.dmp.Diff_MaxSteps = 3
+    self.assertEquals([(self.dmp.DIFF_DELETE, "c"), (self.dmp.DIFF_INSERT, "m"), (self.dmp.DIFF_EQUAL, "a"), (self.dmp.DIFF_DELETE, "t"), (self.dmp.DIFF_INSERT, "p")], self.dmp.diff_bisect(a, b, sys.maxint))
+
   def testDiffMain(self):
     # Perform a trivial diff.
     # Null case.
@@ -534,6 +594,23 @@ class DiffTest(DiffMatchPatchTest):
     texts_textmode = self.diff_rebuildtexts(self.dmp.diff_main(a, b, False))
     self.assertEquals(texts_textmode, texts_linemode)
 
+    # Maximum number of steps, which should not depend on the clock.
+    self.dmp.Diff_Timeout = 0
+    self.dmp.Diff_MaxSteps = 8
+    a = "ACGTTGCAACGTAGCTAGCTAGGCTAGCTTACGATCGATCGATCGGATCATCGACTAGCTAGCATCG" * 2
+    b = "TGCAGTCGATCGTACGTAGCTTAGCGCGATCGATCGTAGCTAGCTGATCGTACGTAGCTAGCTAAC" * 2
+    real_time = time.time
+    try:
+      time.time = None
+      bounded = self.dmp.diff_main(a, b)
+    finally:
+      time.time = real_time
+    self.assertEquals((a, b), self.diff_rebuildtexts(bounded))
+    self.assertEquals(bounded, self.dmp.diff_main(a, b))
+    self.dmp.Diff_MaxSteps = 0
+    optimal = self.dmp.diff_main(a, b)
+    self.assertTrue(self.dmp.diff_levenshtein(optimal) <= self.dmp.diff_levenshtein(bounded))
+
     # Test null inputs.
     try:
       self.dmp.diff_main(None, None)
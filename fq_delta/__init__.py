@@ -1 +1,2 @@
-from fq_delta import *
\ No newline at end of file
+from fq_delta import *
+from records import *
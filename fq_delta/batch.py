@@ -0,0 +1,155 @@
+__author__ = 'averaart'
+"""This module creates the delta files of many samples, listed in a manifest, with a pool of worker processes. The
+largest samples are started first, so the small ones fill up the gaps at the end, and samples that are larger than
+their share of the batch are diffed by the whole pool, so a large sample doesn't run on a single process while the
+others are idle. Samples whose delta archive is already complete, and made with the same settings, are skipped, so a
+batch that was stopped can simply be run again."""
+
+# Batteries included
+import os
+import json
+import zipfile
+
+# Custom modules
+from fq_delta import delta_settings, read_settings
+from server import JobScheduler, check_job, default_delta_name, delta_options
+
+# Samples of at least this many bytes that are also larger than their share of the batch get a diff worker for every
+# process of the batch but their own, see DeltaFile.write_pipelined. They take up all processes while they run, see
+# JobScheduler.
+SPLIT_BYTES = 1 << 28
+
+
+def _archive_name(delta):
+    return (delta[:-4] if delta.endswith('.zip') else delta) + '.zip'
+
+
+def read_manifest(f):
+    """Reads the jobs of a manifest. A manifest is either JSON, a list of objects or an object per line, with at least
+    the keys original and processed, or tab separated lines of the original file, the processed file and optionally
+    the delta file. Empty lines and lines starting with # are skipped. Returns a list of delta jobs as used by
+    server.run_job."""
+    text = f.read()
+    stripped = text.lstrip()
+    if stripped.startswith('['):
+        entries = json.loads(stripped)
+    elif stripped.startswith('{'):
+        entries = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        entries = list()
+        for line in text.splitlines():
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 2:
+                raise ValueError('Expected an original and a processed file, tab separated: ' + line)
+            entry = {'original': fields[0], 'processed': fields[1]}
+            if len(fields) > 2 and fields[2]:
+                entry['delta'] = fields[2]
+            entries.append(entry)
+
+    jobs = list()
+    for n, entry in enumerate(entries):
+        if 'original' not in entry or 'processed' not in entry:
+            raise ValueError('Entry %d of the manifest has no original or processed file.' % (n + 1))
+        job = dict(entry, op='delta')
+        job.setdefault('delta', default_delta_name(str(job['processed'])))
+        job.setdefault('id', str(job['processed']))
+        error = check_job(job)
+        if error is not None:
+            raise ValueError('Entry %d of the manifest: %s' % (n + 1, error))
+        jobs.append(job)
+    return jobs
+
+
+def is_complete(job):
+    """Returns True if the delta archive of a job exists, is newer than both input files, was made with the settings
+    of the job, and holds a delta file and checksum that pass the CRC check of the archive."""
+    archive = _archive_name(str(job['delta']))
+    try:
+        if os.path.getmtime(archive) < max(os.path.getmtime(str(job['original'])),
+                                           os.path.getmtime(str(job['processed']))):
+            return False
+        if read_settings(archive) != delta_settings(**delta_options(job)):
+            return False
+        zf = zipfile.ZipFile(archive)
+        try:
+            names = zf.namelist()
+            return 'md5_checksum' in names and len(names) > 1 and zf.testzip() is None
+        finally:
+            zf.close()
+    except (OSError, IOError, zipfile.BadZipfile):
+        return False
+
+
+def run_batch(jobs, processes=None, skip_complete=True, defaults=None, report=None, split_bytes=SPLIT_BYTES):
+    """Runs delta jobs on a pool of processes, largest processed file first. Settings missing from a job, like codecs
+    and engine, are taken from defaults. Jobs without workers of their own that are at least split_bytes, and larger
+    than their share of the batch, get a diff worker for every process but their own, and run on their own. report is
+    called with every result as it comes in. Returns the results of all jobs, in the order of the manifest, with the
+    throughput of every sample added."""
+    results = [None] * len(jobs)
+    queue = list()
+    for n, job in enumerate(jobs):
+        job = dict(defaults or {}, **job)
+        if skip_complete and is_complete(job):
+            results[n] = {'id': job['id'], 'op': 'delta', 'status': 'skipped',
+                          'delta': _archive_name(str(job['delta']))}
+            if report is not None:
+                report(results[n])
+            continue
+        missing = [name for name in (job['original'], job['processed']) if not os.path.exists(str(name))]
+        if missing:
+            results[n] = {'id': job['id'], 'op': 'delta', 'status': 'error',
+                          'error': "Couldn't find " + ', '.join(missing)}
+            if report is not None:
+                report(results[n])
+            continue
+        size = os.path.getsize(str(job['processed']))
+        job.setdefault('priority', size)
+        queue.append((n, size, job))
+    if not queue:
+        return results
+
+    # The first jobs go to the workers straight away, so submit them in the order they should run.
+    queue.sort(key=lambda (n, size, job): -int(job['priority']))
+    scheduler = JobScheduler(processes)
+    share = sum(size for n, size, job in queue) / scheduler.processes
+    try:
+        for n, size, job in queue:
+            if not job.get('workers') and size >= split_bytes and size > share:
+                job['workers'] = max(scheduler.processes - 1, 1)
+            scheduler.submit(job, _collector(results, n, size, job.get('workers', 0), report))
+        scheduler.join()
+    finally:
+        scheduler.close()
+    return results
+
+
+def _collector(results, n, size, workers, report):
+    def collect(result):
+        result['processed_bytes'] = size
+        result['workers'] = workers
+        if result['status'] == 'ok':
+            seconds = max(result['seconds'], 1e-9)
+            result['records_per_sec'] = result['stats']['records'] / seconds
+            result['mb_per_sec'] = size / seconds / 1e6
+            result['delta_bytes'] = os.path.getsize(result['delta'])
+        results[n] = result
+        if report is not None:
+            report(result)
+    return collect
+
+
+def summary_lines(results):
+    """Yields a tab separated line per result, after a header line."""
+    yield '\t'.join(('id', 'status', 'seconds', 'records', 'records_per_sec', 'mb_per_sec', 'processed_bytes',
+                     'delta_bytes'))
+    for result in results:
+        if result['status'] != 'ok':
+            yield '\t'.join((str(result['id']), result['status'] if result['status'] == 'skipped' else
+                             result['status'] + ': ' + result.get('error', '')) + ('',) * 6)
+            continue
+        yield '%s\tok\t%.3f\t%d\t%.0f\t%.2f\t%d\t%d' % (result['id'], result['seconds'], result['stats']['records'],
+                                                      result['records_per_sec'], result['mb_per_sec'],
+                                                      result['processed_bytes'], result['delta_bytes'])
@@ -0,0 +1,69 @@
+__author__ = 'averaart'
+"""Tests of running a batch of delta jobs. Run them from the root of the repository with: python -m unittest discover -s
+fq_delta -t . -p '*_test.py'"""
+
+# Batteries included
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+# Custom modules
+import batch
+from fq_delta import read_settings
+from benchmark import generate_records, write_records
+
+
+class BatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.original = self.path('original.fastq')
+        self.records = list(generate_records(100, read_length=30))
+        write_records(self.records, self.original)
+        write_records([(i, s[2:], c, q[2:]) for i, s, c, q in self.records], self.path('small.fastq'))
+        write_records([(i, s[1:], c, q[1:]) for i, s, c, q in self.records * 3], self.path('large.fastq'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def manifest(self):
+        return batch.read_manifest(StringIO(''.join('%s\t%s\n' % (self.original, self.path(name))
+                                                    for name in ('small.fastq', 'large.fastq'))))
+
+    def test_read_manifest(self):
+        jobs = self.manifest()
+        self.assertEqual([self.path('small.delta'), self.path('large.delta')], [job['delta'] for job in jobs])
+        jobs = batch.read_manifest(StringIO('{"original": "a", "processed": "b.fq", "codecs": ["trim"]}\n'))
+        self.assertEqual([('a', 'b.fq', ['trim'])], [(j['original'], j['processed'], j['codecs']) for j in jobs])
+        self.assertRaises(ValueError, batch.read_manifest, StringIO('only_original\n'))
+        self.assertRaises(ValueError, batch.read_manifest,
+                          StringIO('{"original": "a", "processed": "b.fq", "priority": "high"}\n'))
+
+    def test_run_batch(self):
+        # The large sample is more than its share of the batch, and gets the workers.
+        results = batch.run_batch(self.manifest(), 2, defaults={'codecs': ['trim']}, split_bytes=1)
+        self.assertEqual(['ok', 'ok'], [result['status'] for result in results])
+        self.assertEqual([0, 1], [result['workers'] for result in results])
+        self.assertEqual('trim', read_settings(self.path('large.delta.zip'))['codecs'])
+
+        # Complete archives are skipped, unless they were made with other settings.
+        results = batch.run_batch(self.manifest(), 2, defaults={'codecs': ['trim']})
+        self.assertEqual(['skipped', 'skipped'], [result['status'] for result in results])
+        results = batch.run_batch(self.manifest(), 2, defaults={'codecs': ['trim'], 'engine': 'banded'})
+        self.assertEqual(['ok', 'ok'], [result['status'] for result in results])
+        self.assertEqual([0, 0], [result['workers'] for result in results])
+        self.assertEqual('banded', read_settings(self.path('small.delta.zip'))['engine'])
+
+    def test_missing(self):
+        os.remove(self.path('small.fastq'))
+        results = batch.run_batch(self.manifest(), 1)
+        self.assertEqual(['error', 'ok'], [result['status'] for result in results])
+
+
+if __name__ == '__main__':
+    unittest.main()
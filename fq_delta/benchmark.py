@@ -0,0 +1,216 @@
+__author__ = 'averaart'
+"""This module generates synthetic fastq files and processed versions of them, and measures how fast delta files are
+created and rebuilt from them. Everything is seeded, so the same arguments always produce the same files, and results
+can be compared between releases."""
+
+# Batteries included
+import os
+import sys
+import time
+import json
+import random
+import platform
+import resource
+import multiprocessing
+
+# Custom modules
+from fq_delta import create_delta, rebuild_fastq, DEFAULT_MAX_EDITS
+
+
+def generate_records(records, read_length=100, seed=1):
+    """Yields synthetic fastq records as tuples of four lines, in the style of SRA downloads of Illumina reads."""
+    rng = random.Random(seed)
+    for n in xrange(1, records + 1):
+        name = 'SRR000001.%d HWI-ST100:1:1101:%d:%d length=%d' % (n, rng.randint(1000, 20000),
+                                                                   rng.randint(1000, 200000), read_length)
+        sequence = ''.join(rng.choice('ACGT') if rng.random() > 0.002 else 'N' for _ in xrange(read_length))
+        # Quality drops towards the end of the read, like it does on the real thing.
+        quality = ''.join(chr(33 + max(2, min(41, int(rng.gauss(38 - 20.0 * i / read_length, 4)))))
+                          for i in xrange(read_length))
+        yield ('@' + name, sequence, '+' + name, quality)
+
+
+def write_records(records, filename):
+    """Writes records to a fastq file and returns the number of bytes written."""
+    size = 0
+    with open(filename, 'w') as f:
+        for record in records:
+            data = '\n'.join(record) + '\n'
+            f.write(data)
+            size += len(data)
+    return size
+
+
+def _trim(records, rng):
+    """Cuts adapters from the end of about a third of the reads, and quality-trims the last bases."""
+    for id_line, sequence, comment, quality in records:
+        end = len(sequence)
+        if rng.random() < 0.3:
+            end = rng.randint(15, end)
+        while end > 0 and ord(quality[end - 1]) - 33 < 20:
+            end -= 1
+        yield id_line, sequence[:end], comment, quality[:end]
+
+
+def _mask(records, rng):
+    """Replaces bases with a quality below 20 with N, like fastq_masker does."""
+    for id_line, sequence, comment, quality in records:
+        sequence = ''.join(base if ord(q) - 33 >= 20 else 'N' for base, q in zip(sequence, quality))
+        yield id_line, sequence, comment, quality
+
+
+def _filter(records, rng):
+    """Removes about 15 percent of the reads."""
+    for record in records:
+        if rng.random() >= 0.15:
+            yield record
+
+
+def _reorder(records, rng):
+    """Shuffles the reads within windows of eight, like multi-threaded tools tend to do."""
+    window = list()
+    for record in records:
+        window.append(record)
+        if len(window) == 8:
+            rng.shuffle(window)
+            for shuffled in window:
+                yield shuffled
+            window = list()
+    rng.shuffle(window)
+    for shuffled in window:
+        yield shuffled
+
+
+def _header_rewrite(records, rng):
+    """Drops the description from the id line and empties the comment line."""
+    for id_line, sequence, comment, quality in records:
+        yield id_line.partition(' ')[0], sequence, '+', quality
+
+
+PROCESSORS = {'trim': _trim, 'mask': _mask, 'filter': _filter, 'reorder': _reorder, 'header_rewrite': _header_rewrite}
+
+
+def _run(queue, function, args, kwargs):
+    """Runs a function in a child process, and reports the time it took and the peak RSS of the child."""
+    start = time.time()
+    function(*args, **kwargs)
+    seconds = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    queue.put((seconds, peak_rss))
+
+
+def measure(function, *args, **kwargs):
+    """Returns the seconds a function takes and the peak RSS in kB, measured in a fresh process."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=(queue, function, args, kwargs))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError('%s failed with exit code %d' % (function.__name__, process.exitcode))
+    return queue.get()
+
+
+def _rebuild(delta_filename, original_filename, out_filename):
+    with open(out_filename, 'w') as out:
+        rebuild_fastq(delta_filename, original_filename, out)
+
+
+def run_benchmarks(workdir, records=100000, read_length=100, processors=None, codecs=(), seed=1, engine='dmp',
+                   max_edits=DEFAULT_MAX_EDITS):
+    """Generates an original file and a processed file per processor in workdir, and measures delta creation and
+    rebuilding of each. Returns the results as a dict that can be written as JSON."""
+    if processors is None:
+        processors = sorted(PROCESSORS)
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    original = os.path.join(workdir, 'original.fastq')
+    original_size = write_records(generate_records(records, read_length, seed), original)
+
+    results = list()
+    for name in processors:
+        rng = random.Random(seed)
+        processed = os.path.join(workdir, name + '.fastq')
+        processed_size = write_records(PROCESSORS[name](generate_records(records, read_length, seed), rng), processed)
+        with open(processed) as f:
+            processed_records = sum(1 for _ in f) // 4
+
+        delta = os.path.join(workdir, name + '.delta')
+        rebuilt = os.path.join(workdir, name + '.rebuilt.fastq')
+        if os.path.exists(delta + '.zip'):
+            os.remove(delta + '.zip')
+        seconds, peak_rss = measure(create_delta, original, processed, delta, codecs=codecs, engine=engine,
+                                     max_edits=max_edits)
+        delta_size = os.path.getsize(delta + '.zip')
+        results.append({'processor': name, 'operation': 'delta', 'records': processed_records,
+                        'seconds': seconds, 'records_per_sec': processed_records / seconds,
+                        'mb_per_sec': processed_size / seconds / 1e6, 'peak_rss_kb': peak_rss,
+                        'processed_bytes': processed_size, 'delta_bytes': delta_size,
+                        'delta_ratio': float(delta_size) / processed_size})
+
+        seconds, peak_rss = measure(_rebuild, delta + '.zip', original, rebuilt)
+        with open(processed) as a:
+            with open(rebuilt) as b:
+                identical = a.read() == b.read()
+        results.append({'processor': name, 'operation': 'rebuild', 'records': processed_records,
+                        'seconds': seconds, 'records_per_sec': processed_records / seconds,
+                        'mb_per_sec': processed_size / seconds / 1e6, 'peak_rss_kb': peak_rss,
+                        'identical': identical})
+
+        for filename in (processed, delta + '.zip', rebuilt):
+            os.remove(filename)
+    os.remove(original)
+
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'time': time.time(),
+            'records': records, 'read_length': read_length, 'original_bytes': original_size, 'seed': seed,
+            'codecs': list(codecs), 'engine': engine, 'max_edits': max_edits, 'results': results}
+
+
+# The most milliseconds an import or script may take on top of starting the interpreter, as measured by
+# measure_startup. A script that can't even print its help within budget makes every short pipeline step slower.
+STARTUP_BUDGET = {'import fq_delta': 40, 'delta --help': 25, 'rebuild --help': 25}
+
+
+def measure_startup(script_dir, repeat=10):
+    """Returns the milliseconds it takes to start the interpreter, and how many more it takes to import fq_delta and
+    to print the help of the delta and rebuild scripts in script_dir. The best of repeat runs is taken."""
+    import subprocess
+
+    def best(command):
+        times = list()
+        with open(os.devnull, 'w') as devnull:
+            for _ in xrange(repeat):
+                start = time.time()
+                subprocess.call(command, stdout=devnull, stderr=devnull)
+                times.append(time.time() - start)
+        return min(times) * 1000
+
+    interpreter = best([sys.executable, '-c', 'pass'])
+    results = {'interpreter': interpreter,
+               'import fq_delta': best([sys.executable, '-c', 'import fq_delta']) - interpreter}
+    for script in ('delta', 'rebuild'):
+        results[script + ' --help'] = best([sys.executable, os.path.join(script_dir, script), '--help']) - interpreter
+    return results
+
+
+def compare(old, new):
+    """Yields a line for every result in new that is also in old, with the relative change in speed and size."""
+    previous = dict(((r['processor'], r['operation']), r) for r in old['results'])
+    for result in new['results']:
+        key = (result['processor'], result['operation'])
+        if key not in previous:
+            continue
+        line = '%-16s %-8s %8.0f rec/s (%+.1f%%)' % (key + (result['records_per_sec'],
+                                                           100.0 * result['records_per_sec'] /
+                                                           previous[key]['records_per_sec'] - 100))
+        if 'delta_bytes' in result:
+            line += '  %10d bytes (%+.1f%%)' % (result['delta_bytes'],
+                                               100.0 * result['delta_bytes'] / previous[key]['delta_bytes'] - 100)
+        yield line
+
+
+def dump(results, f):
+    json.dump(results, f, indent=2, separators=(',', ': '), sort_keys=True)
+    f.write('\n')
@@ -0,0 +1,32 @@
+__author__ = 'averaart'
+"""The names and defaults of the options of fq_delta. This module imports nothing, so the scripts can load it on its own
+to set up their arguments, without waiting for the rest of fq_delta."""
+
+
+# The codecs that store lines with a specialised encoding instead of a diff, see _RecordEncoder.
+CODECS = ('header', 'quality', 'trim')
+
+# The engines that can diff the lines no codec encoded. 'dmp' is diff_match_patch's diff_main. 'banded' only looks for
+# diffs of up to max_edits inserted and deleted characters, which is much faster for reads that were changed just a
+# little, and falls back to diff_main for lines that were changed more. 'bitparallel' diffs sequence lines as packed
+# DNA, see _diff_sequence, and the other lines like 'banded' does.
+ENGINES = ('dmp', 'banded', 'bitparallel')
+DEFAULT_MAX_EDITS = 32
+
+# How processed records are matched to the original records they came from. 'id' compares the id lines up to the first
+# space or tab, so reads still match when a tool drops their description. 'content' compares the sequence and quality
+# lines, for tools that rename reads but leave them as they are otherwise. 'regex' compares the part of the id lines
+# that a regular expression matches, or its first group. All of them look for the match among the next MATCH_WINDOW
+# original records.
+MATCH_MODES = ('id', 'content', 'regex')
+MATCH_WINDOW = 4096
+
+# A processed record that isn't in a full window of the id matcher may still come from further on, when the processed
+# file skipped more original records than fit in the window. Before it is inserted, the original is read ahead by up to
+# LOOKAHEAD_WINDOWS more windows, and the records before its match are only removed once it turns up there. The
+# records read ahead stay in the window, so a run of inserted records only reads ahead once. After SLIDE_MISSES records
+# in a row that aren't there either, the window slides on for every next one, by twice as far each time, up to the
+# lookahead, removing its oldest records, so the records after a gap larger than the lookahead still find their match.
+# Runs of spike-ins shorter than that leave the window where it is.
+LOOKAHEAD_WINDOWS = 16
+SLIDE_MISSES = 64
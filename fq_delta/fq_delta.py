@@ -5,9 +5,11 @@ them and recreating the processed file based on the original file and the differ
 # Batteries included
 import os
 import sys
-from subprocess import Popen, PIPE
+import time
 import hashlib
 import zipfile
+from array import array
+from collections import deque
 try:
     import zlib
     compression = zipfile.ZIP_DEFLATED
@@ -18,6 +20,11 @@ except ImportError:
 # 3rd party imports
 import diff_match_patch as dmp_module
 
+# Custom modules
+from constants import CODECS, ENGINES, DEFAULT_MAX_EDITS, MATCH_MODES, MATCH_WINDOW, LOOKAHEAD_WINDOWS, \
+    SLIDE_MISSES
+from records import BASE_DIGITS, BLOCK_SIZE, find_exceptions, open_records, split_records
+
 
 class InputError(Exception):
     pass
@@ -27,16 +34,497 @@ class ChecksumError(Exception):
     pass
 
 
+class DeltaStats():
+    """Counters and per-stage timers of a DeltaFile. Pass an instance to DeltaFile, create_delta or rebuild_fastq to
+    collect them; without one, nothing is measured."""
+
+    STAGES = ('read_original', 'read_deltas', 'md5', 'diff', 'to_delta', 'codecs', 'decode', 'write', 'extract',
+              'compress', 'read_stall', 'write_stall')
+
+    def __init__(self):
+        self.start = time.time()
+        self.end = None
+        self.records = 0        # Records written to, or read from, the delta file.
+        self.skipped = 0        # Records of the original that were removed in the processed file.
+        self.fallbacks = 0      # Lines that a codec couldn't encode, and were diffed instead.
+        self.engine_fallbacks = 0   # Lines that differed too much for the diff engine, and were diffed by diff_main.
+        self.unmatched = 0      # Processed records without a match in the match window.
+        self.inserted = 0       # Unmatched records that were stored as inserted records.
+        self.bytes_in = 0       # Bytes read from the original and processed files, or the original and delta files.
+        self.bytes_out = 0      # Bytes of the delta archive, or of the rebuilt lines.
+        self.times = dict((stage, 0.0) for stage in self.STAGES)
+
+    def as_dict(self):
+        elapsed = (self.end or time.time()) - self.start
+        return {'records': self.records, 'skipped': self.skipped, 'fallbacks': self.fallbacks,
+                'engine_fallbacks': self.engine_fallbacks, 'unmatched': self.unmatched, 'inserted': self.inserted,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out, 'seconds': elapsed, 'times': self.times}
+
+    def report(self):
+        """Returns the counters and timers as human readable text."""
+        elapsed = (self.end or time.time()) - self.start
+        lines = ['records            %12d' % self.records,
+                 'skipped records    %12d' % self.skipped,
+                 'diff fallbacks     %12d' % self.fallbacks,
+                 'engine fallbacks   %12d' % self.engine_fallbacks,
+                 'unmatched records  %12d' % self.unmatched,
+                 'inserted records   %12d' % self.inserted,
+                 'bytes in           %12d' % self.bytes_in,
+                 'bytes out          %12d' % self.bytes_out,
+                 'total time         %12.3f s' % elapsed]
+        for stage in self.STAGES:
+            if self.times[stage] > 0:
+                lines.append('  %-16s %12.3f s %5.1f%%' % (stage, self.times[stage],
+                                                            100 * self.times[stage] / max(elapsed, 1e-9)))
+        return '\n'.join(lines) + '\n'
+
+
+class ProgressReporter():
+    """Reports the progress of a DeltaFile through its original file. DeltaFile calls update every 'every' records,
+    which does nothing until 'interval' seconds have passed since the last report. Human readable progress goes to out,
+    and a JSON object per report, one per line, to metrics. Either can be None."""
+
+    def __init__(self, out=sys.stderr, metrics=None, interval=5.0, every=1024):
+        self.out = out
+        self.metrics = metrics
+        self.interval = interval
+        self.every = every
+        self.total_bytes = None
+        self.start = time.time()
+        self.last = self.start
+
+    def begin(self, original_file):
+        """Finds the size of the original file, if it is a regular file, to estimate the time left."""
+        self.start = self.last = time.time()
+        try:
+            if os.path.isfile(original_file.name) and not original_file.name.endswith('.qp'):
+                self.total_bytes = os.fstat(original_file.fileno()).st_size
+        except (AttributeError, TypeError, ValueError, OSError):
+            self.total_bytes = None
+
+    def update(self, records, position, done=False):
+        now = time.time()
+        if not done and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = max(now - self.start, 1e-9)
+        report = {'time': now, 'elapsed': elapsed, 'records': records, 'records_per_sec': records / elapsed,
+                  'bytes': position, 'total_bytes': self.total_bytes, 'done': done}
+        line = '%d records, %.0f records/s' % (records, records / elapsed)
+        if position is not None:
+            report['bytes_per_sec'] = position / elapsed
+            line += ', %.1f MB/s' % (position / elapsed / 1e6)
+            if self.total_bytes:
+                report['fraction'] = min(1.0, float(position) / self.total_bytes)
+                report['eta'] = elapsed * (1 - report['fraction']) / max(report['fraction'], 1e-9)
+                line = '%5.1f%%, %s, ETA %d:%02d:%02d' % ((100 * report['fraction'], line) +
+                                                         _hms(report['eta']))
+        if self.out is not None:
+            self.out.write(line + '\n')
+            self.out.flush()
+        if self.metrics is not None:
+            # Only imported here, like json in checkpoints, to keep it out of the startup time of the scripts.
+            import json
+            self.metrics.write(json.dumps(report, sort_keys=True) + '\n')
+            self.metrics.flush()
+
+
+def _hms(seconds):
+    seconds = int(seconds)
+    return seconds // 3600, seconds // 60 % 60, seconds % 60
+
+
 # global variables
 dmp = dmp_module.diff_match_patch()
-dmp.Diff_Timeout = 0.0005     # default is 1
+dmp.Diff_Timeout = 0        # default is 1, diffs are bounded by DIFF_MAX_STEPS instead
 dmp.Match_Distance = 1000   # default is 1000
 dmp.Match_MaxBits = 0       # default is 32, 0 is advised for python
 
+# The number of edit steps a diff of a header, sequence or quality line may take before it gives up and settles for a
+# less optimal delta. Unlike a timeout, this gives the same deltas no matter how fast or busy the machine is.
+DIFF_MAX_STEPS = {'header': 16, 'sequence': 32, 'quality': 32}
+LINE_TYPES = ('header', 'sequence', 'header', 'quality')
+
+
+def _bounded_dmp(max_steps):
+    bounded = dmp_module.diff_match_patch()
+    bounded.Diff_Timeout = 0
+    bounded.Diff_MaxSteps = max_steps
+    bounded.Match_MaxBits = 0
+    return bounded
+
+
+def _pack_read(read):
+    """Packs a read into an integer of two bits per base, the first base in the highest bits. Returns the integer and a
+    list of the positions of all characters other than A, C, G and T."""
+    return int(read.translate(BASE_DIGITS), 4), find_exceptions(read)
+
+
+def _diff_substitutions(t1, t2, max_substitutions):
+    """Diffs two reads of the same length as substituted bases only, by comparing them packed. Returns None if more
+    than max_substitutions bases differ."""
+    length = len(t1)
+    packed1, exceptions1 = _pack_read(t1)
+    packed2, exceptions2 = _pack_read(t2)
+    positions = set(i for i in exceptions1 + exceptions2 if t1[i] != t2[i])
+    differences = packed1 ^ packed2
+    while differences:
+        shift = ((differences & -differences).bit_length() - 1) & ~1
+        positions.add(length - 1 - shift // 2)
+        if len(positions) > max_substitutions:
+            return None
+        differences &= ~(3 << shift)
+    if len(positions) > max_substitutions:
+        return None
+
+    diffs = list()
+    end = 0
+    for i in sorted(positions):
+        if i == end and diffs:
+            # Extend the run of substitutions.
+            diffs[-2:] = [(dmp.DIFF_DELETE, diffs[-2][1] + t1[i]), (dmp.DIFF_INSERT, diffs[-1][1] + t2[i])]
+        else:
+            if i > end:
+                diffs.append((dmp.DIFF_EQUAL, t1[end:i]))
+            diffs += [(dmp.DIFF_DELETE, t1[i]), (dmp.DIFF_INSERT, t2[i])]
+        end = i + 1
+    if end < length:
+        diffs.append((dmp.DIFF_EQUAL, t1[end:]))
+    return diffs
+
+
+def _diff_sequence(line_dmp, t1, t2, max_edits):
+    """Diffs two sequence lines. Reads of the same length that differ by at most max_edits / 2 substituted bases, like
+    masked reads, are compared packed into integers. All other reads are diffed with the bit-parallel algorithm of
+    Myers, which always finds the fewest inserted, deleted and substituted bases."""
+    if len(t1) == len(t2) and t1:
+        diffs = _diff_substitutions(t1, t2, max_edits // 2)
+        if diffs is not None:
+            return diffs
+    return line_dmp.diff_bitParallel(t1, t2)
+
+
+# Transformations the header codec can learn for the id and comment lines. A record whose header line is the learned
+# transformation of the original header line is stored as HEADER_TOKEN instead of a diff.
+def _keep(line):
+    return line
+
+
+def _first_word(line):
+    return line.partition(' ')[0]
+
+
+def _marker(line):
+    return line[:1]
+
+
+HEADER_RULES = {'keep': _keep, 'first_word': _first_word, 'marker': _marker}
+HEADER_TOKEN = '*'
+
+# A quality line stored by the quality codec is QUALITY_TOKEN in the delta file, and its encoding goes to the quality
+# stream.
+QUALITY_TOKEN = '#'
+STREAM_TOKENS = {QUALITY_TOKEN: 'quality'}
+
+# A record whose sequence and quality lines were trimmed by the same amounts is stored by the trim codec as TRIM_TOKEN
+# on both lines, while the left and right trim go to the trims stream: a little endian array of unsigned ints.
+TRIM_TOKEN = '~'
+TRIM_TYPECODE = 'I'
+TRIM_BUFFER = 65536
+
+# Files in a delta archive, next to the delta file itself, that hold the settings and streams of the codecs. The
+# settings file holds the settings the delta file was made with, a name and a value per line, separated by a tab.
+SETTINGS_NAME = 'settings'
+STREAM_NAMES = ('header_rules', 'quality', 'trims', SETTINGS_NAME)
+
+
+def _encode_trim(original, processed):
+    """Returns the left and right trim that turn the sequence and quality lines of the original record into those of
+    the processed record, or None if they weren't trimmed the same way."""
+    length = len(processed[1])
+    if len(processed[3]) != length:
+        return None
+    left = original[1].find(processed[1])
+    if left == -1 or original[3][left:left + length] != processed[3]:
+        return None
+    return left, len(original[1]) - length - left
+
+
+def _encode_quality(t1, t2, left=-1):
+    """Encodes a quality line as the number of characters trimmed from the left and right of the original line,
+    followed by the position and value of every run of substituted characters, all separated by tabs. The left trim of
+    the sequence line can be given as a hint. Returns None if the line can't be encoded this way."""
+    length = len(t2)
+    if length > len(t1) or '\t' in t2:
+        return None
+
+    if 0 <= left <= len(t1) - length and t1[left:left + length] == t2:
+        return '%d\t%d' % (left, len(t1) - length - left)
+    start = t1.find(t2)
+    if start != -1:
+        return '%d\t%d' % (start, len(t1) - length - start)
+
+    best = None
+    for start in set([0, len(t1) - length, left]):
+        if not 0 <= start <= len(t1) - length:
+            continue
+        window = t1[start:start + length]
+        runs = list()
+        substituted = 0
+        run_start = -1
+        for i in xrange(length):
+            if window[i] != t2[i]:
+                if run_start == -1:
+                    run_start = i
+            elif run_start != -1:
+                runs.append('%d\t%s' % (run_start, t2[run_start:i]))
+                substituted += i - run_start
+                run_start = -1
+        if run_start != -1:
+            runs.append('%d\t%s' % (run_start, t2[run_start:]))
+            substituted += length - run_start
+        if best is None or substituted < best[0]:
+            best = (substituted, start, runs)
+
+    substituted, start, runs = best
+    if substituted * 2 > length:
+        return None
+    return '\t'.join(['%d\t%d' % (start, len(t1) - length - start)] + runs)
+
+
+def _decode_quality(t1, code):
+    """Rebuilds a quality line from the original line and the encoding made by _encode_quality."""
+    parts = code.split('\t')
+    try:
+        left, right = int(parts[0]), int(parts[1])
+        positions = [int(n) for n in parts[2::2]]
+    except (ValueError, IndexError):
+        raise ValueError("Invalid quality encoding: " + code)
+    if left < 0 or right < 0 or left + right > len(t1) or len(parts) % 2 != 0:
+        raise ValueError("Invalid quality encoding: " + code)
+
+    window = t1[left:len(t1) - right]
+    if len(parts) == 2:
+        return window
+    pieces = list()
+    pointer = 0
+    for position, run in zip(positions, parts[3::2]):
+        if position < pointer or position + len(run) > len(window):
+            raise ValueError("Invalid quality encoding: " + code)
+        pieces.append(window[pointer:position])
+        pieces.append(run)
+        pointer = position + len(run)
+    pieces.append(window[pointer:])
+    return ''.join(pieces)
+
+
+# A processed record that doesn't come from any original record is stored as its four lines, each preceded by
+# INSERT_TOKEN. It doesn't use up an original record when the file is rebuilt.
+INSERT_TOKEN = '>'
+
+
+def _id_key(record):
+    return record[0].partition(' ')[0].partition('\t')[0]
+
+
+def _content_key(record):
+    return record[1], record[3]
+
+
+def _regex_key(id_regex):
+    # Only imported here, to keep it out of the startup time of the scripts.
+    import re
+    pattern = re.compile(id_regex)
+
+    def key(record):
+        found = pattern.search(record[0])
+        if found is None:
+            return None
+        return found.group(1) if pattern.groups else found.group(0)
+    return key
+
+
+class _WindowMatcher():
+    """Matches processed records to original records by a key, among the next records of the original file. The
+    original records are read ahead into a window, with an index of the first position of every key in it, so a match
+    is found in constant time, and a record that isn't there costs no more than a window. A record that isn't in a full
+    window is looked for in up to lookahead more original records, read past the end of the window, or as far as it
+    takes if lookahead is None. After slide_misses records in a row that weren't found there either, the window slides
+    on, see _slide. A processed record without a match is an inserted record if insert, and is paired with the next
+    original record otherwise, which still gives a valid delta. If tell is given, the position in the original file of
+    every record in the window is kept as well."""
+
+    def __init__(self, read_original, key, size=MATCH_WINDOW, stats=None, insert=False, tell=None, lookahead=0,
+                 slide_misses=SLIDE_MISSES):
+        self.read_original = read_original
+        self.key = key
+        self.size = size
+        self.stats = stats
+        self.insert = insert
+        self.tell = tell
+        self.lookahead = lookahead
+        self.slide_misses = slide_misses
+        self.window = deque()
+        self.keys = deque()
+        self.offsets = deque()
+        # The first position of every key in the window, and the number of later positions of keys that occur more
+        # than once.
+        self.index = dict()
+        self.duplicates = dict()
+        # The number of original records that left the window, which is the number of the first record in it.
+        self.first = 0
+        self.eof = False
+        # The run of records that weren't found in a window as large as the lookahead allows, which ends when the first
+        # record changes, the keys of the first records that slid out during that run, and whether it may slide.
+        self.misses = 0
+        self.missed_at = None
+        self.passed = set()
+        self.sliding = True
+
+    def position(self):
+        """Returns the position in the original file of the first record that wasn't matched or removed yet."""
+        if self.tell is None:
+            raise InputError('The positions of the original records are not kept.')
+        if self.offsets:
+            return self.offsets[0]
+        return self.tell()
+
+    def _append(self, record, offset=None):
+        """Adds an original record to the end of the window."""
+        if record[0] == '':
+            self.eof = True
+            return
+        key = self.key(record)
+        if key is not None:
+            if key in self.index:
+                self.duplicates[key] = self.duplicates.get(key, 0) + 1
+            else:
+                self.index[key] = self.first + len(self.window)
+        self.window.append(record)
+        self.keys.append(key)
+        if self.tell is not None:
+            self.offsets.append(offset)
+
+    def _fill(self):
+        while len(self.window) < self.size and not self.eof:
+            offset = self.tell() if self.tell is not None else None
+            self._append(self.read_original(), offset)
+
+    def _read_ahead(self, key):
+        """Reads original records past the end of a full window, until one with key turns up or the window holds
+        lookahead more records than its size. Returns the position of that record, or None."""
+        while not self.eof and (self.lookahead is None or len(self.window) < self.size + self.lookahead):
+            offset = self.tell() if self.tell is not None else None
+            self._append(self.read_original(), offset)
+            if self.keys and self.keys[-1] == key:
+                return self.index[key]
+        return None
+
+    def _slide(self, key):
+        """Called for a record with key that isn't in a window as large as the lookahead allows. When the processed file
+        skipped more records than that, every record after the gap ends up here, so after slide_misses of them in a row,
+        the window slides on for every next one: its oldest records are removed and the next ones read, until one with
+        key turns up, by twice as many records as the time before, up to lookahead. A run of inserted records that long
+        slides past records the processed file still has, so once a record that slid out is looked for, the window stays
+        put until a record is matched again. Returns the position of the record with key, or None, and a list of the
+        removed records, or None."""
+        if self.missed_at != self.first:
+            self.misses = 0
+            self.passed.clear()
+            self.sliding = True
+        self.misses += 1
+        if key in self.passed:
+            self.sliding = False
+        position = None
+        removed = None
+        if self.sliding and self.misses >= self.slide_misses:
+            count = min(1 << (self.misses - self.slide_misses), self.lookahead)
+            removed = list()
+            while len(removed) < count and not self.eof:
+                if len(self.passed) < self.size:
+                    self.passed.add(self.keys[0])
+                removed.append(self._pop())
+                offset = self.tell() if self.tell is not None else None
+                self._append(self.read_original(), offset)
+                if self.keys and self.keys[-1] == key:
+                    position = self.index[key]
+                    break
+            if self.stats is not None:
+                self.stats.skipped += len(removed)
+        self.missed_at = self.first
+        return position, removed
+
+    def _pop(self):
+        record = self.window.popleft()
+        key = self.keys.popleft()
+        if self.tell is not None:
+            self.offsets.popleft()
+        self.first += 1
+        if key is not None:
+            count = self.duplicates.get(key)
+            if count is None:
+                del self.index[key]
+            else:
+                if count == 1:
+                    del self.duplicates[key]
+                else:
+                    self.duplicates[key] = count - 1
+                for i, other in enumerate(self.keys):
+                    if other == key:
+                        self.index[key] = self.first + i
+                        break
+        return record
+
+    def _remove(self, count, removed):
+        if count > 0:
+            if removed is None:
+                removed = list()
+            removed += [self._pop() for _ in xrange(count)]
+            if self.stats is not None:
+                self.stats.skipped += count
+        return removed
+
+    def match(self, record):
+        """Returns the original record that matches a processed record, or None for an inserted record, and a list of
+        the original records before it that were removed, or None if there are none."""
+        key = self.key(record)
+        # By far the most common case is a match with the next original record, which is the first match in any window,
+        # so the window is only filled when it isn't.
+        if not self.window and not self.eof:
+            offset = self.tell() if self.tell is not None else None
+            original = self.read_original()
+            if key is not None and original[0] != '' and self.key(original) == key:
+                self.first += 1
+                return original, None
+            self._append(original, offset)
+        elif key is not None and self.keys and self.keys[0] == key:
+            return self._pop(), None
+        self._fill()
+        position = self.index.get(key) if key is not None else None
+        removed = None
+        if position is None and key is not None and self.lookahead != 0 and len(self.window) >= self.size:
+            position = self._read_ahead(key)
+            if position is None and not self.eof and self.lookahead is not None:
+                position, removed = self._slide(key)
+        if position is None:
+            if self.stats is not None:
+                self.stats.unmatched += 1
+            if self.insert:
+                if self.stats is not None:
+                    self.stats.inserted += 1
+                return None, removed
+            if not self.window:
+                return ('', '', '', ''), removed
+            return self._pop(), removed
+        removed = self._remove(position - self.first, removed)
+        return self._pop(), removed
+
 
 def _open(name):
     """Opens a file, or streams an unquiping archive."""
     if name[-3:] == '.qp':
+        from subprocess import Popen, PIPE
         return Popen('unquip -c ' + name, shell=True, stdout=PIPE).stdout
     else:
         try:
@@ -45,9 +533,36 @@ def _open(name):
             print "Couldn't find the file..."
 
 
-def create_delta(original_file=sys.stdin, processed_file=sys.stdin, delta_filename='', output_processed=False):
+def delta_settings(codecs=(), engine='dmp', max_edits=DEFAULT_MAX_EDITS, match='id', id_regex=None,
+                   match_window=MATCH_WINDOW):
+    """Returns the settings of create_delta that change the delta file it makes, as they are stored in its archive."""
+    return {'codecs': ','.join(sorted(codecs)), 'engine': str(engine), 'max_edits': str(max_edits),
+            'match': str(match), 'id_regex': id_regex or '', 'match_window': str(match_window)}
+
+
+def read_settings(delta_filename):
+    """Returns the settings stored in a delta archive, or None if it was made before archives held them."""
+    zf = zipfile.ZipFile(delta_filename)
+    try:
+        if SETTINGS_NAME not in zf.namelist():
+            return None
+        return dict(line.split('\t', 1) for line in zf.read(SETTINGS_NAME).split('\n') if line)
+    finally:
+        zf.close()
+
+
+def create_delta(original_file=sys.stdin, processed_file=sys.stdin, delta_filename='', output_processed=False,
+                 codecs=(), stats=None, progress=None, engine='dmp', max_edits=DEFAULT_MAX_EDITS, workers=0,
+                 checkpoint=None, resume=False, match='id', id_regex=None, match_window=MATCH_WINDOW):
     """This function creates a delta file based on an original file and a processed file. Either files could come from
-    standard in."""
+    standard in. Codecs can be any of 'header', 'quality' and 'trim', and engine any of the ENGINES. Counters and
+    timers are collected in stats, if given a DeltaStats, and progress is reported to progress, if given a
+    ProgressReporter. With workers, the files are read in a thread of their own and the records are diffed by that
+    many processes, see DeltaFile.write_pipelined. With checkpoint, the progress is saved every checkpoint seconds, and
+    with resume, a run that was stopped continues from its last checkpoint, see DeltaFile.save_checkpoint. match is one
+    of the MATCH_MODES, with id_regex for 'regex', and match_window the number of original records to look for a match
+    in. With match 'id' and no match_window, no record is inserted, and the original is read as far as it takes to find
+    the match of every record."""
 
     if isinstance(processed_file, str):
         processed_file = _open(processed_file)
@@ -55,24 +570,40 @@ def create_delta(original_file=sys.stdin, processed_file=sys.stdin, delta_filena
     if delta_filename == '':
         delta_filename = processed_file.name
 
-    delta_file = DeltaFile('w', delta_filename, original_file)
+    if workers > 0 and (checkpoint is not None or resume):
+        raise InputError("Checkpoints can't be combined with workers.")
 
-    for line in processed_file:
-        delta_file.write(line)
-        if output_processed:
-            print line,
+    delta_file = DeltaFile('w', delta_filename, original_file, processed_file, codecs=codecs, stats=stats,
+                           progress=progress, engine=engine, max_edits=max_edits, resume=resume, match=match,
+                           id_regex=id_regex, match_window=match_window, resumable=checkpoint is not None)
+
+    records = open_records(processed_file)
+    if resume:
+        records.seek(delta_file.processed_offset)
+    if workers > 0:
+        delta_file.write_pipelined(records, output_processed, workers)
+    else:
+        last_checkpoint = time.time()
+        while records.read_block():
+            delta_file.write_records(records.block, output_processed)
+            if checkpoint is not None and time.time() - last_checkpoint >= checkpoint:
+                delta_file.save_checkpoint(records.offset + records.block.size)
+                last_checkpoint = time.time()
 
     delta_file.close()
 
 
-def rebuild_fastq(delta_filename, original_file=sys.stdin, out=sys.stdout, to_stdout=False):
-    """Recreates the processed file from the original and delta files."""
+def rebuild_fastq(delta_filename, original_file=sys.stdin, out=sys.stdout, to_stdout=False, stats=None,
+                  progress=None):
+    """Recreates the processed file from the original and delta files. If to_stdout, the processed file is written to
+    standard out as well. Counters and timers are collected in stats, if given a DeltaStats, and progress is reported
+    to progress, if given a ProgressReporter."""
 
     # Convert file names to files, and open quip-files while we're at it.
     if isinstance(original_file, str):
         original_file = _open(original_file)
 
-    processed_file = DeltaFile('r', delta_filename, original_file)
+    processed_file = DeltaFile('r', delta_filename, original_file, stats=stats, progress=progress)
 
     if isinstance(out, str):
         out = open(out, 'w')
@@ -80,19 +611,253 @@ def rebuild_fastq(delta_filename, original_file=sys.stdin, out=sys.stdout, to_st
     if out == sys.stdout:
         to_stdout = False
 
-    for line in processed_file:
-        out.write(line + '\n')
-        if to_stdout:
-            sys.stdout.write(line + '\n')
+    output = OutputBuffer([out, sys.stdout] if to_stdout else [out], stats=stats)
+    try:
+        for line in processed_file:
+            output.writeline(line)
+    finally:
+        output.flush()
+
+
+# The number of bytes of lines an OutputBuffer collects before writing them out.
+OUTPUT_BUFFER = 4 << 20
+
+
+class OutputBuffer():
+    """Collects lines, and writes them out in blocks of about size bytes with a single write per file. Every block is
+    joined once and written to all files, so writing the rebuilt file to both a file and standard out costs no extra
+    copies."""
+
+    def __init__(self, files, size=OUTPUT_BUFFER, stats=None):
+        self.files = files
+        self.size = size
+        self.stats = stats
+        self.lines = list()
+        self.pending = 0
+
+    def writeline(self, line):
+        self.lines.append(line)
+        self.pending += len(line) + 1
+        if self.pending >= self.size:
+            self.flush()
+
+    def flush(self):
+        if self.stats is not None:
+            start = time.time()
+        if self.lines:
+            self.lines.append('')
+            block = '\n'.join(self.lines)
+            for f in self.files:
+                f.write(block)
+        for f in self.files:
+            f.flush()
+        self.lines = list()
+        self.pending = 0
+        if self.stats is not None:
+            self.stats.times['write'] += time.time() - start
+
+
+class _RecordEncoder():
+    """Turns an original and a processed record into the four lines of a delta record. A line that starts with one of
+    the STREAM_TOKENS carries an encoding that belongs in the stream of that token, instead of in the delta file."""
+
+    def __init__(self, codecs=(), engine='dmp', max_edits=DEFAULT_MAX_EDITS):
+        for codec in codecs:
+            if codec not in CODECS:
+                raise InputError('Unknown codec: ' + str(codec))
+        if engine not in ENGINES:
+            raise InputError('Unknown diff engine: ' + str(engine))
+        self.codecs = codecs
+        self.engine = engine
+        self.max_edits = max_edits
+        self.header_rules = None
+        self.stats = None
+        bounded = dict((line_type, _bounded_dmp(max_steps)) for line_type, max_steps in DIFF_MAX_STEPS.items())
+        self.dmps = [bounded[line_type] for line_type in LINE_TYPES]
+
+    def learn_headers(self, original, processed):
+        """Picks the header rules for the id and comment lines from the first record."""
+        self.header_rules = list()
+        for t1, t2 in ((original[0], processed[0]), (original[2], processed[2])):
+            rules = [name for name in ('keep', 'first_word', 'marker') if HEADER_RULES[name](t1) == t2]
+            self.header_rules.append(rules[0] if rules else '')
+
+    def diff(self, position, t1, t2):
+        """Diffs a line with the engine, or with diff_main if the engine can't."""
+        line_dmp = self.dmps[position]
+        if self.engine == 'bitparallel' and position == 1:
+            return _diff_sequence(line_dmp, t1, t2, self.max_edits)
+        if self.engine in ('banded', 'bitparallel'):
+            diffs = line_dmp.diff_banded(t1, t2, self.max_edits)
+            if diffs is not None:
+                return diffs
+            if self.stats is not None:
+                self.stats.engine_fallbacks += 1
+        return line_dmp.diff_main(t1, t2)
+
+    def encode(self, original, processed):
+        """Returns the four delta lines that turn the original record into the processed record. If original is None,
+        the processed record was inserted, and is stored as it is."""
+        if original is None:
+            return [INSERT_TOKEN + line for line in processed]
+        stats = self.stats
+        if stats is not None:
+            start = time.time()
+        if 'header' in self.codecs and self.header_rules is None:
+            self.learn_headers(original, processed)
+        trim = None
+        if 'trim' in self.codecs:
+            trim = _encode_trim(original, processed)
+            if trim is None and stats is not None:
+                stats.fallbacks += 1
+        deltas = list()
+        for position, (t1, t2) in enumerate(zip(original, processed)):
+            if trim is not None and position % 2 == 1:
+                deltas.append(TRIM_TOKEN + '%d\t%d' % trim if position == 1 else TRIM_TOKEN)
+                continue
+            elif position % 2 == 0 and self.header_rules is not None:
+                rule = self.header_rules[position // 2]
+                if rule and HEADER_RULES[rule](t1) == t2:
+                    deltas.append(HEADER_TOKEN)
+                    continue
+                if rule and stats is not None:
+                    stats.fallbacks += 1
+            elif position == 3 and 'quality' in self.codecs:
+                code = _encode_quality(t1, t2, original[1].find(processed[1]))
+                if code is not None:
+                    deltas.append(QUALITY_TOKEN + code)
+                    continue
+                if stats is not None:
+                    stats.fallbacks += 1
+            if stats is None:
+                deltas.append(dmp.diff_toDelta(self.diff(position, t1, t2)))
+            else:
+                diff_start = time.time()
+                diffs = self.diff(position, t1, t2)
+                to_delta_start = time.time()
+                deltas.append(dmp.diff_toDelta(diffs))
+                stats.times['diff'] += to_delta_start - diff_start
+                stats.times['to_delta'] += time.time() - to_delta_start
+                start += time.time() - diff_start
+        if stats is not None:
+            stats.times['codecs'] += time.time() - start
+        return deltas
+
+    def write_streams(self, zf, timestamp):
+        """Adds the learned settings to the archive of the delta file."""
+        if self.header_rules is not None:
+            zf.writestr(_zip_info('header_rules', timestamp), '\n'.join(self.header_rules))
+
+
+def _zip_info(name, timestamp):
+    """Returns the ZipInfo of a file that is added to an archive as a string, dated timestamp instead of now."""
+    info = zipfile.ZipInfo(name, time.localtime(timestamp)[:6])
+    info.compress_type = compression
+    info.external_attr = 0600 << 16
+    return info
+
+
+# The version of the checkpoint format.
+CHECKPOINT_VERSION = 1
+
+
+# The number of records sent to a diff worker at a time, and the number of chunks per worker that may wait to be
+# written before reading stalls.
+PIPELINE_CHUNK = 1024
+PIPELINE_DEPTH = 4
+
+# The encoder of a diff worker process.
+_worker_encoder = None
+
+
+def _start_worker(codecs, engine, max_edits):
+    global _worker_encoder
+    _worker_encoder = _RecordEncoder(codecs, engine, max_edits)
+
+
+def _encode_chunk(header_rules, pairs, measure):
+    """Encodes a chunk of (original, processed) record pairs in a diff worker. Returns the deltas of every pair, and
+    the counters and timers of the worker if measure."""
+    encoder = _worker_encoder
+    encoder.header_rules = header_rules
+    encoder.stats = DeltaStats() if measure else None
+    deltas = [encoder.encode(original, processed) for original, processed in pairs]
+    if not measure:
+        return deltas, None
+    stats = encoder.stats
+    return deltas, (stats.fallbacks, stats.engine_fallbacks, stats.times['diff'], stats.times['to_delta'],
+                    stats.times['codecs'])
+
+
+class _RecordDecoder():
+    """Turns the delta lines of a record back into processed lines, using the settings stored next to the deltas."""
+
+    def __init__(self, zf, prefix=''):
+        namelist = zf.namelist()
+        if prefix + 'header_rules' in namelist:
+            self.header_rules = zf.read(prefix + 'header_rules').split('\n')
+        else:
+            self.header_rules = ['', '']
+        self.streams = dict()
+        for token, stream in STREAM_TOKENS.items():
+            if prefix + stream in namelist:
+                self.streams[token] = zf.open(prefix + stream)
+        self.trim_stream = None
+        if prefix + 'trims' in namelist:
+            self.trim_stream = zf.open(prefix + 'trims')
+        self.trims = array(TRIM_TYPECODE)
+        self.trim_pointer = 0
+        self.trim = None
+
+    def _next_trim(self):
+        if self.trim_pointer >= len(self.trims):
+            self.trims = array(TRIM_TYPECODE)
+            if self.trim_stream is not None:
+                self.trims.fromstring(self.trim_stream.read(2 * TRIM_BUFFER * self.trims.itemsize))
+            if len(self.trims) == 0:
+                raise ValueError("Invalid diff operation in diff_fromDelta: " + TRIM_TOKEN)
+            if sys.byteorder == 'big':
+                self.trims.byteswap()
+            self.trim_pointer = 0
+        self.trim = (self.trims[self.trim_pointer], self.trims[self.trim_pointer + 1])
+        self.trim_pointer += 2
+
+    def decode(self, position, t1, delta):
+        if delta == TRIM_TOKEN:
+            if position == 1:
+                self._next_trim()
+            elif position != 3 or self.trim is None:
+                raise ValueError("Invalid diff operation in diff_fromDelta: " + delta)
+            left, right = self.trim
+            if left + right > len(t1):
+                raise ValueError("Trim (%d, %d) is longer than the source text (%d)." % (left, right, len(t1)))
+            if position == 3:
+                self.trim = None
+            return t1[left:len(t1) - right]
+        if delta == HEADER_TOKEN:
+            if position % 2 != 0 or self.header_rules[position // 2] not in HEADER_RULES:
+                raise ValueError("Invalid diff operation in diff_fromDelta: " + delta)
+            return HEADER_RULES[self.header_rules[position // 2]](t1)
+        if delta == QUALITY_TOKEN:
+            if QUALITY_TOKEN not in self.streams:
+                raise ValueError("Invalid diff operation in diff_fromDelta: " + delta)
+            return _decode_quality(t1, self.streams[QUALITY_TOKEN].readline().rstrip('\n'))
+        return dmp.diff_text2(dmp.diff_fromDelta(t1, delta))
 
 
 class DeltaFile():
 
-    def __init__(self, mode, delta_filename, original_file=sys.stdin, processed_file=sys.stdin, reuse=False):
+    def __init__(self, mode, delta_filename, original_file=sys.stdin, processed_file=sys.stdin, reuse=False,
+                 codecs=(), stats=None, progress=None, engine='dmp', max_edits=DEFAULT_MAX_EDITS, resume=False,
+                 match='id', id_regex=None, match_window=MATCH_WINDOW, resumable=False):
 
         self.leftover = list()
+        self.unfinished = ''
         self.mode = mode
         self.reuse = reuse
+        self.stats = stats
+        self.progress = progress
+        self.original_records = 0
 
         # Open an existing deltafile to read the processed file
         if self.mode == 'r':
@@ -104,6 +869,7 @@ class DeltaFile():
                 self.original_file = _open(original_file)
             else:
                 self.original_file = original_file
+            self.records = open_records(self.original_file)
 
             self.md5 = hashlib.md5()
 
@@ -124,18 +890,27 @@ class DeltaFile():
             # minus ".zip". If that fails, find the first file that contains the word "delta".
             # Else just extract the first file you can find. Ugly, I know... :D
 
+            if stats is not None:
+                start = time.time()
             self.filename = self.delta_filename.rpartition('.')[0]
             try:
                 zf.extract(self.filename)
             except KeyError:
+                namelist = [s for s in namelist if s not in STREAM_NAMES]
                 delta_names = [s for s in namelist if "delta" in s]
                 if len(delta_names) > 0:
                     self.filename = delta_names[0]
                 else:
                     self.filename = namelist[0]
                 zf.extract(self.filename)
+            if stats is not None:
+                stats.times['extract'] += time.time() - start
 
             self.deltas = open(self.filename, "r")
+            self.zf = zf
+            self.decoder = _RecordDecoder(self.zf)
+            if progress is not None:
+                progress.begin(self.original_file)
 
         # Write a new deltafile from the processed data.
         elif self.mode == 'w':
@@ -149,6 +924,7 @@ class DeltaFile():
                 self.original_file = _open(original_file)
             else:
                 self.original_file = original_file
+            self.records = open_records(self.original_file)
 
             if isinstance(processed_file, str):
                 self.processed_file = _open(processed_file)
@@ -167,7 +943,43 @@ class DeltaFile():
             if self.delta_filename[-4:] == '.zip':
                 self.delta_filename = self.delta_filename[:-4]
 
-            self.delta_file = open(self.delta_filename, 'a')
+            self.encoder = _RecordEncoder(codecs, engine, max_edits)
+            self.encoder.stats = stats
+            self.settings = delta_settings(codecs, engine, max_edits, match, id_regex, match_window)
+            if match == 'id':
+                key = _id_key
+            elif match == 'content':
+                key = _content_key
+            elif match == 'regex':
+                if not id_regex:
+                    raise InputError('Matching by regex needs an id regex.')
+                key = _regex_key(id_regex)
+            else:
+                raise InputError('Unknown match mode: ' + str(match))
+            # Checkpoints need the position of the first original record the matcher read ahead.
+            tell = self.records.tell if resumable or resume else None
+            if match_window is None:
+                # Without a window, the original is read as far as it takes to find the next record, and no record is
+                # inserted, the way DeltaStore needs it.
+                if match != 'id':
+                    raise InputError('Matching by ' + match + ' needs a match window.')
+                self.matcher = _WindowMatcher(self._read_original, key, 1, stats, False, tell, None)
+            elif match == 'id':
+                self.matcher = _WindowMatcher(self._read_original, key, match_window, stats, True, tell,
+                                              match_window * LOOKAHEAD_WINDOWS)
+            else:
+                self.matcher = _WindowMatcher(self._read_original, key, match_window, stats, False, tell)
+            self.streams = dict()
+            self.trims = array(TRIM_TYPECODE)
+            # The time the archive's files are dated, kept in checkpoints so a resumed run makes the same archive.
+            self.timestamp = int(time.time())
+            self.processed_offset = 0
+            if resume:
+                self._resume()
+            else:
+                self.delta_file = open(self.delta_filename, 'w')
+            if progress is not None:
+                progress.begin(self.original_file)
 
         else:
             raise Exception('Illegal mode: ' + str(mode))
@@ -177,7 +989,8 @@ class DeltaFile():
 
     def reset(self):
         self.deltas.seek(0)
-        self.original_file.seek(0)
+        self.records.reset()
+        self.decoder = _RecordDecoder(self.zf)
         self.leftover = list()
         self.md5 = hashlib.md5()
 
@@ -188,42 +1001,88 @@ class DeltaFile():
             raise IOError("Trying to iterate over closed files...")
 
         while len(self.buffer) <= 0:
-            while len(self.buffer) < 4:
-                delta = ''
-                t1 = ''
-                t2 = ''
-
-                t1 = self.original_file.readline()
+            deltas = list()
+            for _ in xrange(4):
+                if self.stats is not None:
+                    start = time.time()
                 delta = self.deltas.readline().strip()
+                if self.stats is not None:
+                    self.stats.times['read_deltas'] += time.time() - start
+                    self.stats.bytes_in += len(delta) + 1
                 if delta == '':
-                    # End of File
-                    # Check the checksum...
-                    if not self.md5.digest() == self.checksum:
-                        self.close()
-                        raise ChecksumError("Checksum did not match!")
-
-                    if self.reuse:
-                        self.reset()
-                    else:
-                        # Clean up the uncompressed delta file
-                        self.deltas.close()
-                        os.remove(self.filename)
-
-                    # Kill the iterator
-                    raise StopIteration
-
-                diff = dmp.diff_fromDelta(t1.strip(), delta.strip())
-                t2 = dmp.diff_text2(diff)
+                    self._finish()
+                deltas.append(delta)
+
+            if deltas[0][:1] == INSERT_TOKEN:
+                # An inserted record, that doesn't use up an original record.
+                for delta in deltas:
+                    if delta[:1] != INSERT_TOKEN:
+                        raise ValueError("Invalid diff operation in diff_fromDelta: " + delta)
+                    self.buffer.append(delta[1:])
+                if self.stats is not None:
+                    self.stats.records += 1
+                self.buffer.reverse()
+                continue
+
+            if self.stats is not None:
+                start = time.time()
+                position = self.records.tell()
+            original = self.records.next_record()
+            if self.stats is not None:
+                self.stats.times['read_original'] += time.time() - start
+                self.stats.bytes_in += self.records.tell() - position
+            for t1, delta in zip(original, deltas):
+                if self.stats is not None:
+                    start = time.time()
+                t2 = self.decoder.decode(len(self.buffer), t1, delta)
+                if self.stats is not None:
+                    self.stats.times['decode'] += time.time() - start
                 self.buffer.append(t2)
 
+            if self.progress is not None:
+                self.original_records += 1
+                if self.original_records % self.progress.every == 0:
+                    self._report_progress()
+
             # Check if the read was removed. If so, clear the buffer so the next four lines are read.
             if self.buffer == ['', '', '', '']:
                 self.buffer = list()
-
-        nextline = self.buffer.pop(0)
-        self.md5.update(nextline)
+                if self.stats is not None:
+                    self.stats.skipped += 1
+            elif self.stats is not None:
+                self.stats.records += 1
+            self.buffer.reverse()
+
+        nextline = self.buffer.pop()
+        if self.stats is None:
+            self.md5.update(nextline)
+        else:
+            start = time.time()
+            self.md5.update(nextline)
+            self.stats.times['md5'] += time.time() - start
+            self.stats.bytes_out += len(nextline) + 1
         return nextline
 
+    def _finish(self):
+        """Checks the checksum at the end of the delta file, and stops the iteration."""
+        if self.stats is not None:
+            self.stats.end = time.time()
+        if self.progress is not None:
+            self._report_progress(True)
+        if not self.md5.digest() == self.checksum:
+            self.close()
+            raise ChecksumError("Checksum did not match!")
+
+        if self.reuse:
+            self.reset()
+        else:
+            # Clean up the uncompressed delta file
+            self.deltas.close()
+            os.remove(self.filename)
+
+        # Kill the iterator
+        raise StopIteration
+
     def readline(self):
         self.check_reading()
         return self.next()
@@ -232,70 +1091,355 @@ class DeltaFile():
         self.check_reading()
         return [line for line in self]
 
+    def _report_progress(self, done=False):
+        try:
+            position = self.records.tell()
+        except (IOError, AttributeError):
+            position = None
+        self.progress.update(self.original_records, position, done)
+
+    def _read_original(self):
+        """Reads the next record from the original file, as a tuple of stripped lines."""
+        if self.progress is not None:
+            self.original_records += 1
+            if self.original_records % self.progress.every == 0:
+                self._report_progress()
+        if self.stats is None:
+            return self.records.next_record()
+        start = time.time()
+        position = self.records.tell()
+        record = self.records.next_record()
+        self.stats.bytes_in += self.records.tell() - position
+        self.stats.times['read_original'] += time.time() - start
+        return record
+
     def writelines(self, lines, output_processed=False, close_file=False):
-        lines = self.leftover + lines
-
-        while len(lines) >= 4:
-            id1 = self.original_file.readline().strip()
-            id2 = lines.pop(0).strip()
-            seq1 = self.original_file.readline().strip()
-            seq2 = lines.pop(0).strip()
-            com1 = self.original_file.readline().strip()
-            com2 = lines.pop(0).strip()
-            qua1 = self.original_file.readline().strip()
-            qua2 = lines.pop(0).strip()
-            if id2 == '':
+        if self.leftover:
+            lines = self.leftover + lines
+
+        # Walk through the lines with a cursor, four at a time.
+        cursor = 0
+        while len(lines) - cursor >= 4:
+            id2, seq2, com2, qua2 = lines[cursor:cursor + 4]
+            cursor += 4
+            record = (id2.strip(), seq2.strip(), com2.strip(), qua2.strip())
+            if not self._write_record(record):
                 break
-            self.md5.update(id2)
-            self.md5.update(seq2)
-            self.md5.update(com2)
-            self.md5.update(qua2)
-            while id1.partition('\t')[0] != id2.partition('\t')[0]:
-                self.delta_file.write('-' + str(len(id1.strip())) + '\n')
-                self.delta_file.write('-' + str(len(seq1.strip())) + '\n')
-                self.delta_file.write('-' + str(len(com1.strip())) + '\n')
-                self.delta_file.write('-' + str(len(qua1.strip())) + '\n')
-                id1 = self.original_file.readline().strip()
-                seq1 = self.original_file.readline().strip()
-                com1 = self.original_file.readline().strip()
-                qua1 = self.original_file.readline().strip()
-                if id1 == '':
-                    break
-            for (t1, t2) in ((id1, id2), (seq1, seq2), (com1, com2), (qua1, qua2)):
-                diff = dmp.diff_main(t1.strip(), t2.strip())
-                delta = dmp.diff_toDelta(diff) + '\n'
-                self.delta_file.write(delta)
-                if output_processed:
-                    print t2
+            if output_processed:
+                sys.stdout.write('\n'.join(record) + '\n')
 
-        self.leftover = lines
+        self.leftover = lines[cursor:]
 
         if close_file:
             self.close()
 
+    def write_records(self, block, output_processed=False):
+        """Writes all records of a RecordBlock, as read by a RecordReader from the processed file. If output_processed,
+        the block is passed on to standard out with a single write."""
+        for n in xrange(len(block)):
+            if not self._write_record(block.record(n)):
+                break
+        if output_processed:
+            sys.stdout.write('\n'.join(block.lines) + '\n')
+
+    def save_checkpoint(self, processed_offset):
+        """Saves how far the delta file got, to delta_filename.checkpoint: the positions of the next records of the
+        original and processed files, the sizes of the delta file and its streams, and the settings the encoder
+        learned. Everything written so far is flushed to disk first. The checkpoint replaces the previous one in a
+        single rename, so there is always one complete checkpoint."""
+        import json
+        if len(self.trims) > 0:
+            self._flush_trims()
+        files = [self.delta_file] + self.streams.values()
+        for f in files:
+            f.flush()
+            os.fsync(f.fileno())
+        state = {'version': CHECKPOINT_VERSION, 'timestamp': self.timestamp,
+                 'original_offset': self.matcher.position(),
+                 'processed_offset': processed_offset,
+                 'delta_bytes': self.delta_file.tell(),
+                 'streams': dict((name, f.tell()) for name, f in self.streams.items()),
+                 'codecs': list(self.encoder.codecs), 'engine': self.encoder.engine,
+                 'max_edits': self.encoder.max_edits, 'header_rules': self.encoder.header_rules}
+        filename = self.delta_filename + '.checkpoint'
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(state, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(filename + '.tmp', filename)
+
+    def _resume(self):
+        """Continues from the last checkpoint: cuts the delta file and streams back to their size at the checkpoint,
+        moves the original file to its position, and hashes the processed file up to its position. Both files have
+        to be plain files."""
+        import json
+        filename = self.delta_filename + '.checkpoint'
+        try:
+            with open(filename) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            raise InputError('No checkpoint found: ' + filename)
+        if state.get('version') != CHECKPOINT_VERSION:
+            raise InputError('Unknown checkpoint version: ' + str(state.get('version')))
+        encoder = self.encoder
+        if (state['codecs'] != list(encoder.codecs) or state['engine'] != encoder.engine or
+                state['max_edits'] != encoder.max_edits):
+            raise InputError('The checkpoint was made with other codecs, engine or max edits.')
+        for f in (self.original_file, self.processed_file):
+            if not os.path.isfile(getattr(f, 'name', '')) or f.name.endswith('.qp'):
+                raise InputError("Can't resume from a stream, both files have to be plain files.")
+        if state['header_rules'] is not None:
+            encoder.header_rules = [str(rule) for rule in state['header_rules']]
+        self.timestamp = state['timestamp']
+
+        self.delta_file = open(self.delta_filename, 'r+')
+        self.delta_file.truncate(state['delta_bytes'])
+        self.delta_file.seek(0, os.SEEK_END)
+        for name, size in state['streams'].items():
+            name = str(name)
+            self.streams[name] = open(self.delta_filename + '.' + name, 'r+b')
+            self.streams[name].truncate(size)
+            self.streams[name].seek(0, os.SEEK_END)
+
+        self.records.seek(state['original_offset'])
+        self.processed_offset = state['processed_offset']
+        with open(self.processed_file.name) as f:
+            rest = ''
+            position = 0
+            while position < self.processed_offset:
+                data = f.read(min(BLOCK_SIZE, self.processed_offset - position))
+                if data == '':
+                    raise InputError('The processed file is shorter than at the checkpoint.')
+                position += len(data)
+                block, rest = split_records(rest + data, position == self.processed_offset)
+                self.md5.update(''.join(line.strip() for line in block.lines))
+
+    def write_pipelined(self, records, output_processed=False, workers=2, chunk=PIPELINE_CHUNK, depth=PIPELINE_DEPTH):
+        """Writes all records of a RecordReader of the processed file, in three overlapping stages. A reader thread
+        reads both files, matches the records and hashes them, and sends chunks of record pairs to a pool of diff worker
+        processes. Meanwhile, the calling thread writes the deltas of every chunk in order, as soon as they are done.
+        At most depth chunks per worker are on their way, after which the reader waits for the writer, so memory stays
+        flat however fast the files can be read. The delta file is the same as write_records would write."""
+        # Only imported here, to keep them out of the startup time of the scripts.
+        import threading
+        import Queue
+        import multiprocessing
+        stats = self.stats
+        encoder = self.encoder
+        pool = multiprocessing.Pool(workers, _start_worker, (encoder.codecs, encoder.engine, encoder.max_edits))
+        chunks = Queue.Queue(depth * workers)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read_chunks,
+                                  args=(records, output_processed, pool, chunks, chunk, stop))
+        reader.daemon = True
+        reader.start()
+        try:
+            while True:
+                if stats is not None:
+                    start = time.time()
+                item = chunks.get()
+                if item is None:
+                    break
+                result, removals = item
+                if result is None:
+                    # The reader failed, and sent the exc_info of its exception instead of removals.
+                    raise removals[0], removals[1], removals[2]
+                deltas, counters = result.get()
+                if stats is not None:
+                    stats.times['write_stall'] += time.time() - start
+                    start = time.time()
+                for removed, record_deltas in zip(removals, deltas):
+                    self._write_removed(removed)
+                    self._write_deltas(record_deltas)
+                if stats is not None:
+                    stats.times['write'] += time.time() - start
+                    stats.records += len(deltas)
+                    stats.fallbacks += counters[0]
+                    stats.engine_fallbacks += counters[1]
+                    stats.times['diff'] += counters[2]
+                    stats.times['to_delta'] += counters[3]
+                    stats.times['codecs'] += counters[4]
+            reader.join()
+            pool.close()
+        except BaseException:
+            # Stop the reader, and empty the queue so it isn't left waiting for room in it.
+            error = sys.exc_info()
+            stop.set()
+            while reader.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+            raise error[0], error[1], error[2]
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _read_chunks(self, records, output_processed, pool, chunks, chunk, stop):
+        """The reader stage of write_pipelined. Puts the pending result and the removed records of every chunk in the
+        chunks queue, and None when done, or None and the exc_info of the exception that stopped it. Returns early once
+        stop is set."""
+        stats = self.stats
+        encoder = self.encoder
+        measure = stats is not None
+
+        def send(pairs, removals):
+            result = pool.apply_async(_encode_chunk, (encoder.header_rules, pairs, measure))
+            if measure:
+                start = time.time()
+            chunks.put((result, removals))
+            if measure:
+                stats.times['read_stall'] += time.time() - start
+
+        try:
+            pairs = list()
+            removals = list()
+            while not stop.is_set() and records.read_block():
+                block = records.block
+                for n in xrange(len(block)):
+                    record = block.record(n)
+                    if record[0] == '':
+                        break
+                    original, removed = self._match_record(record)
+                    if 'header' in encoder.codecs and encoder.header_rules is None and original is not None:
+                        encoder.learn_headers(original, record)
+                    pairs.append((original, record))
+                    removals.append(removed)
+                    if len(pairs) >= chunk:
+                        send(pairs, removals)
+                        if stop.is_set():
+                            return
+                        pairs = list()
+                        removals = list()
+                if output_processed:
+                    sys.stdout.write('\n'.join(block.lines) + '\n')
+            if pairs:
+                send(pairs, removals)
+            chunks.put(None)
+        except BaseException:
+            chunks.put((None, sys.exc_info()))
+
+    def _write_record(self, record):
+        """Writes the delta of a processed record, preceded by the removal of every original record before its match.
+        Returns False if the record is empty."""
+        if record[0] == '':
+            return False
+        original, removed = self._match_record(record)
+        deltas = self.encoder.encode(original, record)
+        if self.stats is None:
+            self._write_removed(removed)
+            self._write_deltas(deltas)
+        else:
+            start = time.time()
+            self._write_removed(removed)
+            self._write_deltas(deltas)
+            self.stats.times['write'] += time.time() - start
+            self.stats.records += 1
+        return True
+
+    def _match_record(self, record):
+        """Adds a processed record to the checksum, and reads the original file up to the record it matches. Returns
+        that original record, or None if the record was inserted, and a list of the removed original records before it,
+        or None if there are none."""
+        stats = self.stats
+        id2, seq2, com2, qua2 = record
+        if stats is not None:
+            start = time.time()
+            stats.bytes_in += len(id2) + len(seq2) + len(com2) + len(qua2) + 4
+        self.md5.update(id2)
+        self.md5.update(seq2)
+        self.md5.update(com2)
+        self.md5.update(qua2)
+        if stats is not None:
+            stats.times['md5'] += time.time() - start
+        return self.matcher.match(record)
+
+    def _write_removed(self, removed):
+        """Writes the removal of original records: the length of every line, negated."""
+        if removed is None:
+            return
+        for record in removed:
+            for line in record:
+                self.delta_file.write('-' + str(len(line.strip())) + '\n')
+
+    def _write_deltas(self, deltas):
+        """Writes the lines of a delta record, and moves encodings that belong in a stream to that stream."""
+        for delta in deltas:
+            if len(delta) > 1 and delta[0] == TRIM_TOKEN:
+                left, _, right = delta[1:].partition('\t')
+                self.trims.append(int(left))
+                self.trims.append(int(right))
+                if len(self.trims) >= 2 * TRIM_BUFFER:
+                    self._flush_trims()
+                delta = TRIM_TOKEN
+            elif len(delta) > 1 and delta[0] in STREAM_TOKENS:
+                stream = STREAM_TOKENS[delta[0]]
+                if stream not in self.streams:
+                    self.streams[stream] = open(self.delta_filename + '.' + stream, 'w')
+                self.streams[stream].write(delta[1:] + '\n')
+                delta = delta[0]
+            self.delta_file.write(delta + '\n')
+
+    def _flush_trims(self):
+        if 'trims' not in self.streams:
+            self.streams['trims'] = open(self.delta_filename + '.trims', 'wb')
+        if sys.byteorder == 'big':
+            self.trims.byteswap()
+        self.trims.tofile(self.streams['trims'])
+        self.trims = array(TRIM_TYPECODE)
+
     def write(self, string, output_processed=False, close_file=False):
-        lines = string.strip().split('\n')
+        """Writes any amount of processed data, from a single line to megabytes of records. The data doesn't have to
+        end at a line end: an unfinished last line is kept until the next write, or until the file is closed."""
+        lines = (self.unfinished + string).split('\n')
+        self.unfinished = lines.pop()
         self.writelines(lines, output_processed, close_file)
 
     def close(self):
         if self.mode is 'r':
             if not self.deltas.closed:
                 self.deltas.close()
+            self.zf.close()
             try:
                 os.remove(self.filename)
             except OSError:
                 pass
         else:
+            if self.unfinished.strip() != '':
+                unfinished, self.unfinished = self.unfinished, ''
+                self.writelines([unfinished])
             self.delta_file.close()
+            if len(self.trims) > 0:
+                self._flush_trims()
+            for stream in self.streams.values():
+                stream.close()
 
             # Copy the delta file to a compressed archive, and remove the delta file
+            if self.stats is not None:
+                start = time.time()
+            for name in [self.delta_filename] + [self.delta_filename + '.' + name for name in self.streams]:
+                os.utime(name, (self.timestamp, self.timestamp))
             self.zf = zipfile.ZipFile(self.delta_filename + '.zip', mode='w')
             try:
                 self.zf.write(self.delta_filename, self.delta_filename.rpartition('/')[2], compress_type=compression)
-                self.zf.writestr('md5_checksum', self.md5.digest(), compress_type=compression)
+                self.zf.writestr(_zip_info('md5_checksum', self.timestamp), self.md5.digest())
+                self.encoder.write_streams(self.zf, self.timestamp)
+                self.zf.writestr(_zip_info(SETTINGS_NAME, self.timestamp),
+                                 ''.join('%s\t%s\n' % item for item in sorted(self.settings.items())))
+                for name in self.streams:
+                    self.zf.write(self.delta_filename + '.' + name, name, compress_type=compression)
+                    os.remove(self.delta_filename + '.' + name)
                 os.remove(self.delta_filename)
             finally:
                 self.zf.close()
+            if os.path.exists(self.delta_filename + '.checkpoint'):
+                os.remove(self.delta_filename + '.checkpoint')
+            if self.progress is not None:
+                self._report_progress(True)
+            if self.stats is not None:
+                self.stats.end = time.time()
+                self.stats.times['compress'] += self.stats.end - start
+                self.stats.bytes_out = os.path.getsize(self.delta_filename + '.zip')
 
     def check_reading(self):
         if self.mode is not 'r':
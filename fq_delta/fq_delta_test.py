@@ -0,0 +1,417 @@
+__author__ = 'averaart'
+"""Tests of creating and rebuilding delta files. Run them from the root of the repository with: python -m unittest
+discover -s fq_delta -t . -p '*_test.py'"""
+
+# Batteries included
+import os
+import sys
+import random
+import shutil
+import zipfile
+import tempfile
+import threading
+import traceback
+import unittest
+from array import array
+from StringIO import StringIO
+
+# Custom modules
+import fq_delta
+from benchmark import generate_records, write_records
+
+
+class DeltaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # Rebuilding extracts the delta file to the working directory.
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+        self.original = self.path('original.fastq')
+        self.records = list(generate_records(200, read_length=40))
+        write_records(self.records, self.original)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def delta(self, records, **kwargs):
+        """Creates the delta file of processed records, checks that it rebuilds them, and returns the stats of creating
+        it and the archive."""
+        processed = self.path('processed.fastq')
+        write_records(records, processed)
+        stats = fq_delta.DeltaStats()
+        fq_delta.create_delta(self.original, processed, self.path('processed.delta'), stats=stats, **kwargs)
+        out = StringIO()
+        fq_delta.rebuild_fastq(self.path('processed.delta.zip'), self.original, out)
+        self.assertEqual(open(processed).read(), out.getvalue())
+        return stats, zipfile.ZipFile(self.path('processed.delta.zip'))
+
+    def deltas(self, zf):
+        """Returns the delta lines of an archive, four per record."""
+        return zf.read('processed.delta').split('\n')[:-1]
+
+
+class HeaderTest(DeltaTest):
+
+    def test_first_word(self):
+        # Dropping the description is matched on the id up to the first space, and learned by the header codec.
+        processed = [(i.partition(' ')[0], s, '+', q) for i, s, c, q in self.records]
+        stats, zf = self.delta(processed, codecs=('header',))
+        self.assertEqual(0, stats.inserted)
+        self.assertEqual(0, stats.fallbacks)
+        self.assertEqual('first_word\nmarker', zf.read('header_rules'))
+        deltas = self.deltas(zf)
+        self.assertEqual(['*'] * len(processed), deltas[0::4])
+        self.assertEqual(['*'] * len(processed), deltas[2::4])
+
+    def test_fallback(self):
+        # A record that doesn't follow the learned rule is diffed.
+        processed = [(i, s, '+', q) for i, s, c, q in self.records]
+        processed[5] = (processed[5][0], processed[5][1], '+x', processed[5][3])
+        stats, zf = self.delta(processed, codecs=('header',))
+        self.assertEqual(1, stats.fallbacks)
+        self.assertEqual('keep\nmarker', zf.read('header_rules'))
+        self.assertNotEqual('*', self.deltas(zf)[5 * 4 + 2])
+
+    def test_without_codec(self):
+        processed = [(i.partition(' ')[0], s, c, q) for i, s, c, q in self.records]
+        stats, zf = self.delta(processed)
+        self.assertEqual(0, stats.inserted)
+        self.assertNotIn('header_rules', zf.namelist())
+
+
+class QualityTest(DeltaTest):
+
+    def assertQuality(self, t1, t2, code, left=-1):
+        self.assertEqual(code, fq_delta._encode_quality(t1, t2, left))
+        if code is not None:
+            self.assertEqual(t2, fq_delta._decode_quality(t1, code))
+
+    def test_encode(self):
+        # Trims.
+        self.assertQuality('ABCDEFG', 'ABCDEFG', '0\t0')
+        self.assertQuality('ABCDEFG', 'CDE', '2\t2')
+        self.assertQuality('ABCDEFG', '', '0\t7')
+        # The left trim of the sequence line picks between equal windows.
+        self.assertQuality('AAAAB', 'AA', '0\t3')
+        self.assertQuality('AAAAB', 'AA', '2\t1', 2)
+        # Substituted runs, after a trim.
+        self.assertQuality('IIIIIIII', 'II##IIII', '0\t0\t2\t##')
+        self.assertQuality('IIIIIIII', '#IIIII#', '0\t1\t0\t#\t6\t#')
+        self.assertQuality('ABCDEFGH', 'BCXEFGY', '1\t0\t2\tX\t6\tY')
+        # Lines that can't be encoded.
+        self.assertQuality('IIII', 'IIIII', None)
+        self.assertQuality('IIII', '####', None)
+        self.assertQuality('IIII', 'I\tII', None)
+
+    def test_decode_invalid(self):
+        for code in ('', '1', 'a\t0', '3\t2', '0\t0\t1', '0\t0\t3\tXX', '0\t0\t2\tX\t1\tX'):
+            self.assertRaises(ValueError, fq_delta._decode_quality, 'IIII', code)
+
+    def test_stream(self):
+        # Quality trimmed reads with low qualities masked, like fastq_quality_trimmer and a masker would leave them.
+        processed = list()
+        for n, (i, s, c, q) in enumerate(self.records):
+            end = len(s) - n % 7
+            processed.append((i, s[:end], c, ''.join('#' if ord(x) < 40 else x for x in q[:end])))
+        processed[3] = (processed[3][0], processed[3][1], processed[3][2], '!' * len(processed[3][3]))
+        stats, zf = self.delta(processed, codecs=('quality',))
+        self.assertEqual(1, stats.fallbacks)
+        deltas = self.deltas(zf)[3::4]
+        self.assertEqual(len(processed) - 1, deltas.count('#'))
+        self.assertNotEqual('#', deltas[3])
+        self.assertEqual(len(processed) - 1, len(zf.read('quality').split('\n')) - 1)
+
+
+class TrimTest(DeltaTest):
+
+    def test_encode(self):
+        original = ('@r', 'ACGTACGTAA', '+', 'ABCDEFGHIJ')
+        self.assertEqual((0, 0), fq_delta._encode_trim(original, ('@r', 'ACGTACGTAA', '+', 'ABCDEFGHIJ')))
+        self.assertEqual((2, 3), fq_delta._encode_trim(original, ('@r', 'GTACG', '+', 'CDEFG')))
+        self.assertEqual((0, 10), fq_delta._encode_trim(original, ('@r', '', '+', '')))
+        # Trimmed differently, or changed as well.
+        self.assertEqual(None, fq_delta._encode_trim(original, ('@r', 'GTACG', '+', 'CDEF')))
+        self.assertEqual(None, fq_delta._encode_trim(original, ('@r', 'GTACG', '+', 'DEFGH')))
+        self.assertEqual(None, fq_delta._encode_trim(original, ('@r', 'GTNCG', '+', 'CDEFG')))
+
+    def test_stream(self):
+        # A small buffer, so the trims are written and read in several pieces.
+        trim_buffer = fq_delta.TRIM_BUFFER
+        fq_delta.TRIM_BUFFER = 8
+        try:
+            processed = [(i, s[n % 3:len(s) - n % 11], c, q[n % 3:len(q) - n % 11])
+                         for n, (i, s, c, q) in enumerate(self.records)]
+            processed[7] = (processed[7][0], 'N' + processed[7][1][1:], processed[7][2], processed[7][3])
+            stats, zf = self.delta(processed, codecs=('trim',))
+        finally:
+            fq_delta.TRIM_BUFFER = trim_buffer
+        self.assertEqual(1, stats.fallbacks)
+        trims = array(fq_delta.TRIM_TYPECODE, zf.read('trims'))
+        if sys.byteorder == 'big':
+            trims.byteswap()
+        expected = [(n % 3, n % 11) for n in xrange(len(processed)) if n != 7]
+        self.assertEqual(expected, zip(trims[0::2], trims[1::2]))
+        deltas = self.deltas(zf)
+        self.assertEqual(len(processed) - 1, deltas[1::4].count('~'))
+        self.assertEqual(deltas[1::4].count('~'), deltas[3::4].count('~'))
+
+    def test_missing_trims(self):
+        processed = [(i, s[1:], c, q[1:]) for i, s, c, q in self.records]
+        stats, zf = self.delta(processed, codecs=('trim',))
+        # Leave out the trims stream.
+        broken = zipfile.ZipFile(self.path('broken.delta.zip'), 'w')
+        for name in zf.namelist():
+            if name != 'trims':
+                broken.writestr(name if name != 'processed.delta' else 'broken.delta', zf.read(name))
+        broken.close()
+        delta_file = fq_delta.DeltaFile('r', self.path('broken.delta.zip'), self.original)
+        try:
+            self.assertRaises(ValueError, list, delta_file)
+        finally:
+            delta_file.close()
+        self.assertFalse(os.path.exists('broken.delta'))
+
+
+class CheckpointTest(DeltaTest):
+
+    def test_resume(self):
+        processed = [(i.partition(' ')[0], s[n % 4:], '+', q[n % 4:])
+                     for n, (i, s, c, q) in enumerate(self.records) if n % 9 != 4]
+        write_records(processed, self.path('processed.fastq'))
+        lines = open(self.path('processed.fastq')).read().split('\n')
+        first = '\n'.join(lines[:240]) + '\n'
+        second = '\n'.join(lines[240:480]) + '\n'
+        delta = self.path('resumed.delta')
+        codecs = ('header', 'trim')
+
+        # A run that saves a checkpoint after the first records, and is stopped after some more.
+        delta_file = fq_delta.DeltaFile('w', delta, self.original, self.path('processed.fastq'), codecs=codecs,
+                                        resumable=True)
+        delta_file.write_records(fq_delta.split_records(first)[0])
+        delta_file.save_checkpoint(len(first))
+        delta_file.write_records(fq_delta.split_records(second)[0])
+        for f in [delta_file.delta_file, delta_file.original_file] + delta_file.streams.values():
+            f.close()
+
+        self.assertRaises(fq_delta.InputError, fq_delta.create_delta, self.original, self.path('processed.fastq'),
+                          delta, codecs=('trim',), resume=True)
+        fq_delta.create_delta(self.original, self.path('processed.fastq'), delta, codecs=codecs, resume=True)
+        self.assertFalse(os.path.exists(delta + '.checkpoint'))
+        stats, zf = self.delta(processed, codecs=codecs)
+        resumed = zipfile.ZipFile(delta + '.zip')
+        for name in zf.namelist():
+            self.assertEqual(zf.read(name), resumed.read(name if name != 'processed.delta' else 'resumed.delta'))
+        self.assertRaises(fq_delta.InputError, fq_delta.create_delta, self.original, self.path('processed.fastq'),
+                          delta, resume=True)
+
+
+class WriteTest(DeltaTest):
+
+    def test_chunks(self):
+        # Processed data written in chunks of any size, ending anywhere in a line, gives the delta create_delta makes.
+        processed = [(i.partition(' ')[0], s[n % 5:], '+', q[n % 5:])
+                     for n, (i, s, c, q) in enumerate(self.records) if n % 7 != 3]
+        codecs = ('header', 'trim')
+        stats, zf = self.delta(processed, codecs=codecs)
+        data = open(self.path('processed.fastq')).read()
+        rng = random.Random(1)
+        for trailing in (True, False):
+            delta_file = fq_delta.DeltaFile('w', self.path('chunked.delta'), self.original,
+                                            self.path('processed.fastq'), codecs=codecs)
+            position = 0
+            end = len(data) if trailing else len(data) - 1
+            while position < end:
+                size = rng.choice((1, 2, 3, 17, 100, 1000))
+                delta_file.write(data[position:min(position + size, end)])
+                position += size
+            delta_file.close()
+            chunked = zipfile.ZipFile(self.path('chunked.delta.zip'))
+            self.assertEqual(sorted(zf.namelist()), sorted(name if name != 'chunked.delta' else 'processed.delta'
+                                                           for name in chunked.namelist()))
+            for name in zf.namelist():
+                self.assertEqual(zf.read(name), chunked.read(name if name != 'processed.delta' else 'chunked.delta'))
+
+
+class PipelinedTest(DeltaTest):
+
+    def processed(self):
+        return [(i.partition(' ')[0], s[n % 3:len(s) - n % 5], '+', q[n % 3:len(q) - n % 5])
+                for n, (i, s, c, q) in enumerate(self.records) if n % 11 != 2]
+
+    def test_same_delta(self):
+        codecs = ('header', 'quality', 'trim')
+        stats, zf = self.delta(self.processed(), codecs=codecs)
+        serial = dict((name, zf.read(name)) for name in zf.namelist())
+        stats, zf = self.delta(self.processed(), codecs=codecs, workers=2)
+        self.assertEqual(serial, dict((name, zf.read(name)) for name in zf.namelist()))
+
+    def test_write_error(self):
+        # The writer fails while the reader waits for room in the queue. The reader stops, and the error keeps the
+        # traceback of where it was raised.
+        def fail(deltas):
+            raise IOError('No space left on device')
+
+        threads = threading.active_count()
+        write_records(self.processed(), self.path('processed.fastq'))
+        delta_file = fq_delta.DeltaFile('w', self.path('processed.delta'), self.original,
+                                        self.path('processed.fastq'))
+        delta_file._write_deltas = fail
+        try:
+            delta_file.write_pipelined(fq_delta.open_records(delta_file.processed_file), workers=1, chunk=2, depth=1)
+        except IOError:
+            self.assertEqual('fail', traceback.extract_tb(sys.exc_info()[2])[-1][2])
+        else:
+            self.fail('The error of the writer was lost.')
+        finally:
+            delta_file.delta_file.close()
+        self.assertEqual(threads, threading.active_count())
+
+    def test_read_error(self):
+        # An error of the reader thread is raised by the writer, with the traceback of the reader.
+        def fail(record):
+            raise ValueError('Broken record')
+
+        write_records(self.processed(), self.path('processed.fastq'))
+        delta_file = fq_delta.DeltaFile('w', self.path('processed.delta'), self.original,
+                                        self.path('processed.fastq'))
+        delta_file._match_record = fail
+        try:
+            delta_file.write_pipelined(fq_delta.open_records(delta_file.processed_file), workers=1)
+        except ValueError:
+            self.assertEqual('fail', traceback.extract_tb(sys.exc_info()[2])[-1][2])
+        else:
+            self.fail('The error of the reader was lost.')
+        finally:
+            delta_file.delta_file.close()
+
+
+class WindowTest(DeltaTest):
+
+    def test_spike_ins(self):
+        # Spike-ins ahead of the reads are inserted, and leave the matching of the reads after them alone.
+        spikes = [('@spike%d' % n, s, c, q) for n, (i, s, c, q) in enumerate(self.records[:20])]
+        stats, zf = self.delta(spikes + self.records, match_window=8)
+        self.assertEqual(20, stats.inserted)
+        self.assertEqual(0, stats.skipped)
+
+    def test_without_window(self):
+        processed = [self.records[0], self.records[150], self.records[199]]
+        stats, zf = self.delta(processed, match_window=None)
+        self.assertEqual(0, stats.inserted)
+        self.assertEqual(197, stats.skipped)
+        self.assertRaises(fq_delta.InputError, self.delta, processed, match='content', match_window=None)
+
+    def test_gap(self):
+        # A gap larger than the lookahead only costs the records that are inserted before the window slid past it.
+        self.records = list(generate_records(1000, read_length=40))
+        write_records(self.records, self.original)
+        stats, zf = self.delta(self.records[:10] + self.records[400:], match_window=1)
+        self.assertEqual(390, stats.skipped - stats.inserted)
+        self.assertTrue(stats.inserted < 100)
+
+
+class MatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.originals = [('@r%d x' % n, 'ACGT'[n % 4] * (n // 4 + 1), '+', 'I' * (n // 4 + 1)) for n in xrange(20)]
+        self.stats = fq_delta.DeltaStats()
+
+    def matcher(self, key=fq_delta._id_key, size=8, **kwargs):
+        originals = iter(self.originals)
+        return fq_delta._WindowMatcher(lambda: next(originals, ('', '', '', '')), key, size, self.stats, **kwargs)
+
+    def assertMatches(self, matcher, processed, expected):
+        """Checks the original record and the numbers of the removed records every processed record is matched to."""
+        for record, (original, removed) in zip(processed, expected):
+            found, found_removed = matcher.match(record)
+            self.assertEqual(original if original is None or isinstance(original, tuple) else self.originals[original],
+                             found)
+            self.assertEqual(removed, found_removed and [self.originals.index(r) for r in found_removed])
+
+    def test_removed(self):
+        processed = [('@r%d' % n, 'N', '+', '#') for n in (0, 3, 4, 10)]
+        self.assertMatches(self.matcher(), processed, [(0, None), (3, [1, 2]), (4, None), (10, [5, 6, 7, 8, 9])])
+        self.assertEqual(7, self.stats.skipped)
+        self.assertEqual(0, self.stats.unmatched)
+
+    def test_outside_window(self):
+        # Without insertion, a record that isn't in the window is paired with the next original record.
+        processed = [self.originals[6], self.originals[0]]
+        self.assertMatches(self.matcher(fq_delta._content_key, 4), processed, [(0, None), (1, None)])
+        self.assertEqual(2, self.stats.unmatched)
+        self.assertEqual(0, self.stats.inserted)
+
+    def test_duplicates(self):
+        # Records 1, 5 and 9 have the same content, and each is matched to the first one left in the window.
+        for n in (5, 9):
+            self.originals[n] = (self.originals[n][0],) + self.originals[1][1:]
+        processed = [self.originals[1]] * 3
+        self.assertMatches(self.matcher(fq_delta._content_key), processed,
+                           [(1, [0]), (5, [2, 3, 4]), (9, [6, 7, 8])])
+
+    def test_end(self):
+        # Once the original file is used up, a record is paired with an empty record.
+        matcher = self.matcher(size=32)
+        self.assertMatches(matcher, [('@r19', 'N', '+', '#'), ('@r5', 'N', '+', '#')],
+                           [(19, range(19)), (('', '', '', ''), None)])
+
+    def test_inserted(self):
+        # A run of inserted records longer than the old limit of 16 misses doesn't remove any original records.
+        matcher = self.matcher(size=2, insert=True, lookahead=4)
+        spikes = [('@spike%d' % n, 'N', '+', '#') for n in xrange(20)]
+        self.assertMatches(matcher, spikes, [(None, None)] * len(spikes))
+        self.assertMatches(matcher, self.originals, [(n, None) for n in xrange(len(self.originals))])
+        self.assertEqual(20, self.stats.inserted)
+        self.assertEqual(0, self.stats.skipped)
+
+    def test_lookahead(self):
+        # A record past the window is found when it is within the lookahead, and only then are the records before it
+        # removed.
+        matcher = self.matcher(size=2, insert=True, lookahead=4)
+        processed = [('@r%d' % n, 'N', '+', '#') for n in (0, 5, 19, 6)]
+        self.assertMatches(matcher, processed, [(0, None), (5, [1, 2, 3, 4]), (None, None), (6, None)])
+        self.assertEqual(1, self.stats.inserted)
+
+    def test_slide(self):
+        # Once slide_misses records in a row weren't found, the window slides on by 1, 2, 4 records up to the lookahead,
+        # and removes the records it slid past.
+        matcher = self.matcher(size=4, insert=True, lookahead=4, slide_misses=2)
+        processed = [('@r%d' % n, 'N', '+', '#') for n in (0, 14, 15, 16, 17, 18, 19)]
+        self.assertMatches(matcher, processed, [(0, None), (None, None), (None, [1]), (None, [2, 3]),
+                                                (None, [4, 5, 6, 7]), (18, range(8, 18)), (19, None)])
+        self.assertEqual(4, self.stats.inserted)
+        self.assertEqual(17, self.stats.skipped)
+
+    def test_slide_back(self):
+        # After a run of spike-ins, the window stops sliding once the records that slid out are looked for.
+        matcher = self.matcher(size=2, insert=True, lookahead=2, slide_misses=2)
+        spikes = [('@spike%d' % n, 'N', '+', '#') for n in xrange(3)]
+        processed = [self.originals[0]] + spikes + self.originals[1:]
+        self.assertMatches(matcher, processed, [(0, None), (None, None), (None, [1]), (None, [2, 3]), (None, None),
+                                                (None, None), (None, None)] + [(n, None) for n in xrange(4, 20)])
+        self.assertEqual(6, self.stats.inserted)
+        self.assertEqual(3, self.stats.skipped)
+
+    def test_without_window(self):
+        # Without a limit, the original is read as far as it takes.
+        matcher = self.matcher(size=1, lookahead=None)
+        processed = [('@r%d' % n, 'N', '+', '#') for n in (2, 19)]
+        self.assertMatches(matcher, processed, [(2, [0, 1]), (19, range(3, 19))])
+
+    def test_regex_key(self):
+        self.assertEqual('SRR1.5', fq_delta._regex_key('(SRR[0-9.]+)')(('@read_SRR1.5 x',)))
+        self.assertEqual('read_SRR1', fq_delta._regex_key('read_[A-Z]+[0-9]')(('@read_SRR1.5 x',)))
+        self.assertEqual(None, fq_delta._regex_key('(SRR[0-9.]+)')(('@read x',)))
+        # The example of the README finds the same key in an original id and in the id UMI extraction made of it.
+        key = fq_delta._regex_key(r'^@([^\s_]+)')
+        self.assertEqual(['SRR1.5'] * 3, [key((id_line,)) for id_line in ('@SRR1.5 HWI-ST', '@SRR1.5_ACGT HWI-ST',
+                                                                          '@SRR1.5_ACGT')])
+
+
+if __name__ == '__main__':
+    unittest.main()
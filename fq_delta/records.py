@@ -0,0 +1,183 @@
+__author__ = 'averaart'
+"""This module reads fastq records a block at a time, which is much faster than reading them a line at a time."""
+
+# Batteries included
+import os
+import string
+
+
+# The number of bytes read from a file per block.
+BLOCK_SIZE = 1 << 20
+
+# Translates bases into base 4 digits, two bits per base. Anything that isn't A, C, G or T becomes a 0 as well, and is
+# listed as an exception.
+BASE_DIGITS = string.maketrans(''.join(chr(i) for i in xrange(256)),
+                               ''.join('0123'['ACGT'.index(chr(i))] if chr(i) in 'ACGT' else '0' for i in xrange(256)))
+
+
+def find_exceptions(sequence):
+    """Returns the positions of all characters in a sequence other than A, C, G and T, in order."""
+    exceptions = list()
+    for c in set(sequence.translate(None, 'ACGT')):
+        i = sequence.find(c)
+        while i != -1:
+            exceptions.append(i)
+            i = sequence.find(c, i + 1)
+    exceptions.sort()
+    return exceptions
+
+
+class RecordBlock(object):
+    """A block of whole fastq records. The lines of the block are split off one string in a single pass, and stripped
+    when a record is taken out."""
+
+    __slots__ = ('lines', 'size')
+
+    def __init__(self, lines, size):
+        self.lines = lines
+        self.size = size
+
+    def __len__(self):
+        return (len(self.lines) + 3) // 4
+
+    def line(self, i):
+        """Returns line i of the block, stripped."""
+        if i >= len(self.lines):
+            return ''
+        return self.lines[i].strip()
+
+    def record(self, n):
+        """Returns record n of the block as a tuple of four stripped lines."""
+        lines = self.lines
+        i = 4 * n
+        if i + 4 > len(lines):
+            return self.line(i), self.line(i + 1), self.line(i + 2), self.line(i + 3)
+        return lines[i].strip(), lines[i + 1].strip(), lines[i + 2].strip(), lines[i + 3].strip()
+
+
+def split_records(data, final=False):
+    """Splits the whole records at the start of data into lines. Returns a RecordBlock of those records and the rest
+    of data. If final, the rest is taken as the last record, even if it has fewer than four lines."""
+    lines = data.split('\n')
+    # The last element is an unfinished line, or empty if data ends with a line end.
+    last = lines.pop()
+    if final:
+        if last != '':
+            lines.append(last)
+        return RecordBlock(lines, len(data)), ''
+    complete = len(lines) - len(lines) % 4
+    rest = lines[complete:]
+    del lines[complete:]
+    rest.append(last)
+    rest = '\n'.join(rest)
+    return RecordBlock(lines, len(data) - len(rest)), rest
+
+
+class RecordReader():
+    """Reads the records of a fastq file a block at a time, and hands them out one at a time. After the last record,
+    every record is four empty lines, the way four calls to readline at the end of a file would return them."""
+
+    def __init__(self, f, block_size=BLOCK_SIZE):
+        self.f = f
+        self.block_size = block_size
+        self.seek(0, False)
+
+    def reset(self):
+        self.seek(0)
+
+    def seek(self, position, rewind=True):
+        """Continues reading at a position in the file, which has to be the start of a record."""
+        if rewind:
+            self.f.seek(position)
+        self.block = RecordBlock([], 0)
+        self.record = 0
+        self.rest = ''
+        self.offset = position
+        self.eof = False
+        # The position in the file of a record of the block, for tell.
+        self.told = (0, position)
+
+    def read_block(self):
+        """Reads the next block of records. Returns False if the file has no more records."""
+        while not self.eof:
+            data = self.f.read(self.block_size)
+            self.eof = data == ''
+            block, self.rest = split_records(self.rest + data, self.eof)
+            if len(block) > 0:
+                self.offset += self.block.size
+                self.block = block
+                self.record = 0
+                self.told = (0, self.offset)
+                return True
+        return False
+
+    def next_record(self):
+        """Returns the next record as a tuple of four stripped lines."""
+        if self.record >= len(self.block) and not self.read_block():
+            return '', '', '', ''
+        self.record += 1
+        return self.block.record(self.record - 1)
+
+    def skip(self, records):
+        """Skips a number of records."""
+        while records > 0:
+            if self.record >= len(self.block) and not self.read_block():
+                return
+            skipped = min(records, len(self.block) - self.record)
+            self.record += skipped
+            records -= skipped
+
+    def tell(self):
+        """Returns the position in the file of the next record."""
+        record, position = self.told
+        if record > self.record:
+            record, position = 0, self.offset
+        lines = self.block.lines
+        position += sum(len(line) for line in lines[4 * record:4 * self.record]) + 4 * (self.record - record)
+        self.told = (self.record, position)
+        return min(position, self.offset + self.block.size)
+
+
+class MappedRecordReader(RecordReader):
+    """Reads the records of a plain file through a memory map. Blocks are sliced straight from the map at record
+    boundaries, without reading the file into a buffer first or carrying the rest of a block over to the next."""
+
+    def __init__(self, f, block_size=BLOCK_SIZE):
+        # Only imported here, as pipes and the scripts' help don't need it.
+        import mmap
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        RecordReader.__init__(self, f, block_size)
+
+    def seek(self, position, rewind=True):
+        RecordReader.seek(self, position, False)
+
+    def read_block(self):
+        position = self.offset + self.block.size
+        block_size = self.block_size
+        while position < len(self.map):
+            end = position + block_size
+            final = end >= len(self.map)
+            if not final:
+                # Cut the slice at a line end, so only whole lines are split.
+                end = self.map.rfind('\n', position, end) + 1
+            block, _ = split_records(self.map[position:end], final)
+            if len(block) > 0:
+                self.offset = position
+                self.block = block
+                self.record = 0
+                self.told = (0, position)
+                return True
+            # A record that doesn't fit in a block.
+            block_size *= 2
+        self.eof = True
+        return False
+
+
+def open_records(f, block_size=BLOCK_SIZE):
+    """Returns a MappedRecordReader for a plain file, and a RecordReader for anything else, like pipes."""
+    try:
+        if os.path.isfile(f.name) and os.fstat(f.fileno()).st_size > 0 and f.tell() == 0:
+            return MappedRecordReader(f, block_size)
+    except (AttributeError, IOError, ValueError, EnvironmentError):
+        pass
+    return RecordReader(f, block_size)
@@ -0,0 +1,94 @@
+__author__ = 'averaart'
+"""Tests of reading records a block at a time. Run them from the root of the repository with: python -m unittest
+discover -s fq_delta -t . -p '*_test.py'"""
+
+# Batteries included
+import os
+import shutil
+import tempfile
+import unittest
+
+# Custom modules
+import records
+from benchmark import generate_records
+
+
+class RecordReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.records = list(generate_records(50, read_length=100))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, newline, trailing):
+        """Writes the records with the given line end, and returns the file name and the offset of every record, plus
+        the size of the file."""
+        offsets = list()
+        data = ''
+        for record in self.records:
+            offsets.append(len(data))
+            data += ''.join(line + newline for line in record)
+        if not trailing:
+            data = data[:-len(newline)]
+        offsets.append(len(data))
+        filename = os.path.join(self.dir, 'records.fastq')
+        with open(filename, 'wb') as f:
+            f.write(data)
+        return filename, offsets
+
+    def cases(self):
+        """Yields a reader for every line end, with and without a last line end, at every block size, and the offsets
+        of its records."""
+        for newline in ('\n', '\r\n'):
+            for trailing in (True, False):
+                filename, offsets = self.write(newline, trailing)
+                for block_size in (64, 1000, 1 << 20):
+                    for reader in (records.RecordReader, records.MappedRecordReader):
+                        with open(filename, 'rb') as f:
+                            yield reader(f, block_size), offsets
+
+    def test_read(self):
+        for reader, offsets in self.cases():
+            for record, offset in zip(self.records, offsets):
+                self.assertEqual(offset, reader.tell())
+                self.assertEqual(record, reader.next_record())
+            self.assertEqual(offsets[-1], reader.tell())
+            self.assertEqual(('', '', '', ''), reader.next_record())
+
+    def test_seek(self):
+        for reader, offsets in self.cases():
+            for n in (30, 0, 49, 7):
+                reader.seek(offsets[n])
+                self.assertEqual(offsets[n], reader.tell())
+                self.assertEqual(self.records[n], reader.next_record())
+                self.assertEqual(offsets[n + 1], reader.tell())
+            reader.reset()
+            self.assertEqual(self.records[0], reader.next_record())
+
+    def test_skip(self):
+        for reader, offsets in self.cases():
+            reader.skip(3)
+            self.assertEqual(offsets[3], reader.tell())
+            reader.next_record()
+            reader.skip(40)
+            self.assertEqual(offsets[44], reader.tell())
+            self.assertEqual(self.records[44], reader.next_record())
+            reader.skip(100)
+            self.assertEqual(('', '', '', ''), reader.next_record())
+
+    def test_open_records(self):
+        filename, offsets = self.write('\n', True)
+        with open(filename) as f:
+            self.assertTrue(isinstance(records.open_records(f), records.MappedRecordReader))
+        with open(os.path.join(self.dir, 'empty.fastq'), 'w') as f:
+            pass
+        with open(os.path.join(self.dir, 'empty.fastq')) as f:
+            reader = records.open_records(f)
+            self.assertFalse(isinstance(reader, records.MappedRecordReader))
+            self.assertEqual(('', '', '', ''), reader.next_record())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,298 @@
+__author__ = 'averaart'
+"""This module runs delta and rebuild jobs in a long-running server, so a workflow that makes thousands of small delta
+files doesn't pay for starting python and importing the modules every time. Jobs are JSON objects, one per line, sent
+on standard in or over a Unix socket. They are run by a pool of worker processes that stay up between jobs, highest
+priority first, and a JSON line with the metrics of every job is sent back when it is done. The peak memory in those
+metrics, worker_peak_rss_kb, is the peak of the worker process over all the jobs it ran so far, not of the job itself.
+
+A job looks like this, where everything but op and the files is optional:
+
+    {"id": "sample1", "op": "delta", "original": "sample.fastq", "processed": "sample.trimmed.fastq",
+     "delta": "sample.trimmed.delta", "codecs": ["trim"], "engine": "bitparallel", "max_edits": 32, "match": "id",
+     "id_regex": null, "match_window": 4096, "workers": 0, "priority": 1}
+    {"id": "sample2", "op": "rebuild", "original": "sample.fastq", "delta": "sample.trimmed.delta.zip",
+     "out": "sample.trimmed.fastq"}
+
+The line {"op": "shutdown"} stops the server once all jobs are done."""
+
+# Batteries included
+import os
+import sys
+import json
+import time
+import heapq
+import socket
+import resource
+import threading
+import traceback
+import multiprocessing
+import multiprocessing.pool
+import SocketServer
+
+# Custom modules
+from fq_delta import create_delta, rebuild_fastq, DeltaStats, DEFAULT_MAX_EDITS, MATCH_WINDOW
+
+
+OPERATIONS = ('delta', 'rebuild')
+
+# The keys of a job that have to be whole numbers, if they are given, and the smallest value they may have.
+NUMBER_KEYS = {'priority': None, 'workers': 0, 'max_edits': 0, 'match_window': 1}
+
+
+def default_delta_name(processed):
+    """Returns the name the delta script gives the delta file of a processed file."""
+    if processed.endswith('.fastq'):
+        return processed[:-6] + '.delta'
+    return processed + '.delta'
+
+
+def delta_options(job):
+    """Returns the settings of a delta job that change the delta file, as keyword arguments of create_delta, with the
+    defaults filled in."""
+    id_regex = str(job['id_regex']) if job.get('id_regex') else None
+    return {'codecs': tuple(str(codec) for codec in job.get('codecs', ())), 'engine': str(job.get('engine', 'dmp')),
+            'max_edits': int(job['max_edits'] if job.get('max_edits') is not None else DEFAULT_MAX_EDITS),
+            'match': str(job.get('match') or ('regex' if id_regex else 'id')), 'id_regex': id_regex,
+            'match_window': int(job.get('match_window') or MATCH_WINDOW)}
+
+
+def run_job(job):
+    """Runs a job in a worker process. Returns the metrics of the job, or the error that stopped it."""
+    started = time.time()
+    result = {'id': job.get('id'), 'op': job.get('op'), 'pid': os.getpid(), 'started': started,
+              'queued_seconds': started - job.get('submitted', started)}
+    stats = DeltaStats()
+    try:
+        if job['op'] == 'delta':
+            delta = str(job.get('delta') or default_delta_name(str(job['processed'])))
+            create_delta(str(job['original']), str(job['processed']), delta, stats=stats,
+                         workers=int(job.get('workers') or 0), **delta_options(job))
+            result['delta'] = (delta[:-4] if delta.endswith('.zip') else delta) + '.zip'
+        else:
+            with open(str(job['out']), 'w') as out:
+                rebuild_fastq(str(job['delta']), str(job['original']), out, stats=stats)
+            result['out'] = job['out']
+        result['status'] = 'ok'
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+    result['seconds'] = time.time() - started
+    result['stats'] = stats.as_dict()
+    # A worker runs many jobs, and the peak is over all of them.
+    result['worker_peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        result['worker_peak_rss_kb'] //= 1024
+    return result
+
+
+def check_job(job):
+    """Returns an error message if a job can't be run, or None."""
+    if not isinstance(job, dict):
+        return 'A job has to be a JSON object.'
+    if job.get('op') not in OPERATIONS:
+        return 'Unknown operation: ' + str(job.get('op'))
+    required = ('original', 'processed') if job['op'] == 'delta' else ('original', 'delta', 'out')
+    missing = [key for key in required if not job.get(key)]
+    if missing:
+        return 'Missing ' + ', '.join(missing)
+    for key, minimum in sorted(NUMBER_KEYS.items()):
+        value = job.get(key)
+        if value is None:
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, long)):
+            return '%s has to be a whole number, not %s' % (key, json.dumps(value))
+        if minimum is not None and value < minimum:
+            return '%s has to be at least %d' % (key, minimum)
+    return None
+
+
+class _Process(multiprocessing.Process):
+    """A worker process that isn't a daemon, so a delta job with workers can start diff worker processes of its own."""
+
+    def _get_daemon(self):
+        return False
+
+    def _set_daemon(self, value):
+        pass
+
+    daemon = property(_get_daemon, _set_daemon)
+
+
+class _Pool(multiprocessing.pool.Pool):
+    Process = _Process
+
+
+class JobScheduler():
+    """Runs jobs in a pool of worker processes. Only as many jobs as there are workers are handed to the pool at a time,
+    so a job with a higher priority that is submitted later still goes before the jobs that are waiting. Jobs with the
+    same priority run in the order they were submitted. A delta job with workers diffs in that many more processes, so
+    it takes up one of the pool's processes for itself and one per diff worker, up to all of them. It waits until that
+    many are free, and the jobs after it wait for it, so there are never more busy processes than the pool has."""
+
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = _Pool(self.processes)
+        self.pending = list()
+        self.running = 0
+        self.submitted = 0
+        self.condition = threading.Condition()
+
+    def submit(self, job, reply):
+        """Queues a job. reply is called with the result of the job when it is done, from another thread."""
+        job = dict(job, submitted=time.time())
+        with self.condition:
+            heapq.heappush(self.pending, (-int(job.get('priority') or 0), self.submitted, job, reply))
+            self.submitted += 1
+            self._dispatch()
+
+    def _slots(self, job):
+        """Returns the number of the pool's processes a job takes up: its own, and one per diff worker."""
+        return min(1 + max(int(job.get('workers') or 0), 0), self.processes)
+
+    def _dispatch(self):
+        while self.pending:
+            slots = self._slots(self.pending[0][2])
+            if self.running + slots > self.processes:
+                break
+            _, _, job, reply = heapq.heappop(self.pending)
+            self.running += slots
+            self.pool.apply_async(run_job, (job,), callback=self._done_callback(reply, slots))
+
+    def _done_callback(self, reply, slots):
+        def done(result):
+            with self.condition:
+                self.running -= slots
+                self._dispatch()
+                self.condition.notify_all()
+            reply(result)
+        return done
+
+    def join(self):
+        """Waits until all submitted jobs are done."""
+        with self.condition:
+            while self.running or self.pending:
+                self.condition.wait(1.0)
+
+    def close(self):
+        self.join()
+        self.pool.close()
+        self.pool.join()
+
+
+class _Replies():
+    """Writes the results of the jobs that came in on one stream back to it as JSON lines, from any thread, and keeps
+    count of the jobs that weren't answered yet."""
+
+    def __init__(self, out):
+        self.out = out
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def reply(self, result):
+        with self.condition:
+            try:
+                self.out.write(json.dumps(result, sort_keys=True) + '\n')
+                self.out.flush()
+            except IOError:
+                # The other side is gone, but the scheduler's threads have to go on.
+                pass
+
+    def submit(self, scheduler, job):
+        with self.condition:
+            self.waiting += 1
+        try:
+            scheduler.submit(job, self._done)
+        except BaseException:
+            with self.condition:
+                self.waiting -= 1
+                self.condition.notify_all()
+            raise
+
+    def _done(self, result):
+        try:
+            self.reply(result)
+        finally:
+            with self.condition:
+                self.waiting -= 1
+                self.condition.notify_all()
+
+    def join(self):
+        """Waits until every job submitted through this stream is answered."""
+        with self.condition:
+            while self.waiting:
+                self.condition.wait(1.0)
+
+
+def _handle_line(line, scheduler, replies):
+    """Submits the job on a line. Returns False if the line asks the server to shut down."""
+    if line.strip() == '':
+        return True
+    try:
+        job = json.loads(line)
+    except ValueError as e:
+        replies.reply({'status': 'error', 'error': 'Invalid JSON: %s' % e})
+        return True
+    if isinstance(job, dict) and job.get('op') == 'shutdown':
+        return False
+    error = check_job(job)
+    if error is not None:
+        replies.reply({'id': job.get('id') if isinstance(job, dict) else None, 'status': 'error', 'error': error})
+        return True
+    replies.submit(scheduler, job)
+    return True
+
+
+def serve_stream(scheduler, f=sys.stdin, out=sys.stdout):
+    """Reads jobs from f until it ends or a shutdown line, and writes their results to out as they are done. Returns
+    when all jobs are done."""
+    replies = _Replies(out)
+    for line in iter(f.readline, ''):
+        if not _handle_line(line, scheduler, replies):
+            break
+    replies.join()
+
+
+class _JobHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        replies = _Replies(self.wfile)
+        for line in iter(self.rfile.readline, ''):
+            if not _handle_line(line, self.server.scheduler, replies):
+                threading.Thread(target=self.server.shutdown).start()
+                break
+        # Answer every job of this connection before closing it, without waiting for the jobs of other connections.
+        replies.join()
+
+
+class JobServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Serves jobs on a Unix socket. Every connection can send any number of jobs, and gets the results of its own
+    jobs back on the same connection."""
+
+    daemon_threads = True
+
+    def __init__(self, path, scheduler):
+        if os.path.exists(path):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, _JobHandler)
+        self.scheduler = scheduler
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+
+def submit(path, jobs):
+    """Sends jobs to a JobServer on a Unix socket, and returns their results in the order they finished."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    try:
+        for job in jobs:
+            client.sendall(json.dumps(job) + '\n')
+        client.shutdown(socket.SHUT_WR)
+        return [json.loads(line) for line in client.makefile('r') if line.strip()]
+    finally:
+        client.close()
@@ -0,0 +1,127 @@
+__author__ = 'averaart'
+"""Tests of the job server. Run them from the root of the repository with: python -m unittest discover -s fq_delta -t
+. -p '*_test.py'"""
+
+# Batteries included
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+# Custom modules
+import server
+from benchmark import generate_records, write_records
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.records = list(generate_records(100, read_length=30))
+        self.original = self.path('original.fastq')
+        write_records(self.records, self.original)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_run_job(self):
+        # Renamed reads only match with the id regex, in a job with diff workers of its own.
+        renamed = [('@read%d_%s' % (n, i[1:].partition(' ')[0]), s, c, q)
+                   for n, (i, s, c, q) in enumerate(self.records)]
+        write_records(renamed, self.path('renamed.fastq'))
+        result = server.run_job({'id': 'renamed', 'op': 'delta', 'original': self.original,
+                                 'processed': self.path('renamed.fastq'), 'id_regex': '(SRR[0-9.]+)', 'workers': 1})
+        self.assertEqual('ok', result['status'], result.get('traceback'))
+        self.assertEqual(0, result['stats']['unmatched'])
+        self.assertEqual(self.path('renamed.delta.zip'), result['delta'])
+        self.assertTrue(result['worker_peak_rss_kb'] > 0)
+
+        result = server.run_job({'op': 'rebuild', 'original': self.original, 'delta': result['delta'],
+                                 'out': self.path('rebuilt.fastq')})
+        self.assertEqual('ok', result['status'], result.get('traceback'))
+        self.assertEqual(open(self.path('renamed.fastq')).read(), open(self.path('rebuilt.fastq')).read())
+
+        result = server.run_job({'op': 'delta', 'original': self.original, 'processed': self.original,
+                                 'match': 'nonsense'})
+        self.assertEqual('error', result['status'])
+
+    def test_check_job(self):
+        self.assertEqual(None, server.check_job({'op': 'delta', 'original': 'a', 'processed': 'b'}))
+        self.assertNotEqual(None, server.check_job({'op': 'delta', 'original': 'a'}))
+        self.assertNotEqual(None, server.check_job({'op': 'copy'}))
+        self.assertNotEqual(None, server.check_job(['delta']))
+        for key, value in (('priority', 'high'), ('workers', 1.5), ('max_edits', True), ('match_window', 0)):
+            self.assertNotEqual(None, server.check_job({'op': 'delta', 'original': 'a', 'processed': 'b', key: value}))
+        self.assertEqual(None, server.check_job({'op': 'delta', 'original': 'a', 'processed': 'b', 'priority': None}))
+
+    def test_scheduler_slots(self):
+        # A job with a diff worker takes up both processes, so the job after it only starts when it is done.
+        results = list()
+        scheduler = server.JobScheduler(2)
+        try:
+            for job_id, workers in (('split', 1), ('small', 0)):
+                scheduler.submit({'id': job_id, 'op': 'delta', 'original': self.original, 'processed': self.original,
+                                  'delta': self.path(job_id + '.delta'), 'workers': workers}, results.append)
+            scheduler.join()
+        finally:
+            scheduler.close()
+        split, small = sorted(results, key=lambda result: result['id'] != 'split')
+        self.assertEqual(['ok', 'ok'], [split['status'], small['status']])
+        self.assertTrue(small['started'] >= split['started'] + split['seconds'])
+        self.assertEqual(0, scheduler.running)
+
+    def test_serve_stream(self):
+        jobs = [{'id': 'a', 'op': 'delta', 'original': self.original, 'processed': self.original},
+                'not json', {'id': 'b', 'op': 'rebuild'},
+                {'id': 'd', 'op': 'delta', 'original': self.original, 'processed': self.original, 'priority': 'high'},
+                {'id': 'e', 'op': 'delta', 'original': self.original, 'processed': self.original, 'priority': None},
+                {'op': 'shutdown'},
+                {'id': 'c', 'op': 'delta', 'original': self.original, 'processed': self.original}]
+        out = StringIO()
+        scheduler = server.JobScheduler(1)
+        try:
+            server.serve_stream(scheduler, StringIO('\n'.join(job if isinstance(job, str) else json.dumps(job)
+                                                              for job in jobs) + '\n'), out)
+        finally:
+            scheduler.close()
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([None, 'a', 'b', 'd', 'e'], sorted(result.get('id') for result in results))
+        self.assertEqual(['error', 'error', 'error', 'ok', 'ok'], sorted(result['status'] for result in results))
+
+    def test_connections(self):
+        # The job of the first connection waits for its original, which is a named pipe, while the second connection
+        # gets its answer.
+        os.mkfifo(self.path('waiting.fastq'))
+        scheduler = server.JobScheduler(2)
+        job_server = server.JobServer(self.path('socket'), scheduler)
+        thread = threading.Thread(target=job_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            waiting = list()
+            first = threading.Thread(target=lambda: waiting.extend(server.submit(self.path('socket'), [
+                {'id': 'waiting', 'op': 'delta', 'original': self.path('waiting.fastq'), 'processed': self.original,
+                 'delta': self.path('waiting.delta')}])))
+            first.start()
+            results = server.submit(self.path('socket'), [{'id': 'quick', 'op': 'delta', 'original': self.original,
+                                                           'processed': self.original}])
+            self.assertEqual(['quick'], [result['id'] for result in results])
+            self.assertEqual([], waiting)
+            with open(self.path('waiting.fastq'), 'w') as f:
+                f.write(open(self.original).read())
+            first.join(30)
+            self.assertEqual(['ok'], [result['status'] for result in waiting])
+        finally:
+            job_server.shutdown()
+            job_server.server_close()
+            scheduler.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
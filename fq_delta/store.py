@@ -0,0 +1,340 @@
+__author__ = 'averaart'
+"""This module keeps many processed versions of the same original fastq file in a single archive. All versions share one
+index of the original's records and one set of removal maps, so every version only stores the deltas of the records it
+actually kept. Those deltas are stored in content-addressed blocks, so blocks that are identical between versions are
+only stored once."""
+
+# Batteries included
+import os
+import shutil
+import tempfile
+import hashlib
+import zipfile
+
+# Custom modules
+from fq_delta import _open, compression, STREAM_NAMES, INSERT_TOKEN, DeltaFile, ChecksumError, _RecordDecoder
+from records import open_records, MappedRecordReader
+
+
+# Number of original records in a delta block, and between two byte offsets in the record index.
+BLOCK_RECORDS = 4096
+
+
+class StoreError(Exception):
+    pass
+
+
+def _build_index(original_file):
+    """Scans the original file and returns the number of records, the number of bytes and the byte offset of every
+    BLOCK_RECORDS'th record."""
+    records = 0
+    offsets = list()
+    reader = open_records(original_file)
+    while True:
+        if records % BLOCK_RECORDS == 0:
+            position = reader.tell()
+        if reader.next_record()[0] == '':
+            break
+        if records % BLOCK_RECORDS == 0:
+            offsets.append(position)
+        records += 1
+    return records, reader.tell(), offsets
+
+
+def _split_deltas(deltas, removed):
+    """Reads the four-line records of a delta stream. Records that only delete lines are added to the removal map as
+    (start, count) ranges, all other records are yielded together with their record number."""
+    record = 0
+    while True:
+        lines = [deltas.readline().strip() for _ in range(4)]
+        if lines[0] == '':
+            break
+        if lines[0].startswith(INSERT_TOKEN):
+            raise StoreError("A delta file with inserted records can't be stored, every record has to come from the "
+                             "original.")
+        if all(line.startswith('-') and '\t' not in line for line in lines):
+            if removed and removed[-1][0] + removed[-1][1] == record:
+                removed[-1] = (removed[-1][0], removed[-1][1] + 1)
+            else:
+                removed.append((record, 1))
+        else:
+            yield record, lines
+        record += 1
+
+
+class _BlockWriter():
+    """Collects the deltas of a version per block of BLOCK_RECORDS original records, and stores every block as four
+    columns (id, sequence, comment and quality deltas). Each column is named after its SHA-1 digest, so a column that is
+    already in the archive is not stored again. Only the digests of the archive are kept in memory."""
+
+    def __init__(self, zf, known):
+        self.zf = zf
+        self.known = known
+        self.block = 0
+        self.columns = ([], [], [], [])
+        self.pending = False
+        self.digests = list()
+
+    def add(self, record, lines):
+        while record // BLOCK_RECORDS > self.block:
+            self.flush()
+        for column, line in zip(self.columns, lines):
+            column.append(line + '\n')
+        self.pending = True
+
+    def flush(self):
+        digests = list()
+        for column in self.columns:
+            data = ''.join(column)
+            digest = hashlib.sha1(data).hexdigest()
+            if 'blocks/' + digest not in self.known:
+                self.zf.writestr('blocks/' + digest, data, compress_type=compression)
+                self.known.add('blocks/' + digest)
+            digests.append(digest)
+            del column[:]
+        self.digests.append('\t'.join(digests) + '\n')
+        self.block += 1
+        self.pending = False
+
+    def close(self):
+        if self.pending:
+            self.flush()
+        return ''.join(self.digests)
+
+
+class DeltaStore():
+    """An archive holding any number of named delta versions of one original file.
+
+    The archive contains:
+        index                       The record count, byte count and record offsets of the original.
+        removals/<md5>              A removal map, stored once for all versions that removed the same records.
+        blocks/<sha1>               One column of a delta block, stored once for all versions that share it.
+        versions/<name>/blocks      The digests of the columns of every block of this version.
+        versions/<name>/removals    The name of the removal map used by this version.
+        versions/<name>/<stream>    The codec settings and streams of this version, see STREAM_NAMES.
+        versions/<name>/md5_checksum
+    """
+
+    def __init__(self, filename, original_file=None):
+        self.filename = filename
+        self.original_file = original_file
+
+    def _namelist(self):
+        if not os.path.exists(self.filename):
+            return list()
+        zf = zipfile.ZipFile(self.filename)
+        try:
+            return zf.namelist()
+        finally:
+            zf.close()
+
+    def versions(self):
+        """Returns the names of all versions in the store."""
+        prefix = 'versions/'
+        suffix = '/md5_checksum'
+        return sorted(name[len(prefix):-len(suffix)] for name in self._namelist()
+                      if name.startswith(prefix) and name.endswith(suffix))
+
+    def index(self):
+        """Returns the record count, byte count and record offsets of the original file."""
+        zf = zipfile.ZipFile(self.filename)
+        try:
+            lines = zf.read('index').split('\n')
+        except KeyError:
+            raise StoreError('No index found.')
+        finally:
+            zf.close()
+        records, size = int(lines[0]), int(lines[1])
+        offsets = [int(line) for line in lines[2:] if line != '']
+        return records, size, offsets
+
+    def add(self, name, delta_filename):
+        """Adds an existing delta file (as written by DeltaFile) to the store under the given name."""
+        if name == '' or '/' in name:
+            raise StoreError('Illegal version name: ' + name)
+        namelist = self._namelist()
+        if 'versions/' + name + '/md5_checksum' in namelist:
+            raise StoreError('Version already exists: ' + name)
+
+        source = zipfile.ZipFile(delta_filename)
+        try:
+            source_names = source.namelist()
+            if 'md5_checksum' not in source_names:
+                raise ChecksumError('No checksum found.')
+            checksum = source.read('md5_checksum')
+            source_names.remove('md5_checksum')
+            streams = [s for s in source_names if s in STREAM_NAMES]
+            source_names = [s for s in source_names if s not in STREAM_NAMES]
+            delta_names = [s for s in source_names if "delta" in s]
+            if len(delta_names) == 0:
+                delta_names = source_names
+
+            temp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(self.filename)))
+            try:
+                self._append(name, source.open(delta_names[0]), checksum, namelist,
+                             [(stream, source.extract(stream, temp_dir)) for stream in streams])
+            finally:
+                shutil.rmtree(temp_dir)
+        finally:
+            source.close()
+
+    def add_processed(self, name, processed_file, codecs=()):
+        """Creates a delta between the store's original file and a processed file, and adds it to the store. The
+        records are matched by id without a window, so gaps of any size are stored as removed records."""
+        if not isinstance(self.original_file, str):
+            raise StoreError('The store needs the name of the original file to add versions.')
+        temp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(self.filename)))
+        try:
+            delta_filename = os.path.join(temp_dir, name + '.delta')
+            delta_file = DeltaFile('w', delta_filename, self.original_file, processed_file, codecs=codecs,
+                                   match_window=None)
+            records = open_records(delta_file.processed_file)
+            while records.read_block():
+                delta_file.write_records(records.block)
+            delta_file.close()
+            self.add(name, delta_filename + '.zip')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def _append(self, name, deltas, checksum, namelist, streams):
+        index = None
+        if 'index' not in namelist:
+            if not isinstance(self.original_file, str):
+                raise StoreError('The store needs the name of the original file to build its index.')
+            original_file = _open(self.original_file)
+            try:
+                records, size, offsets = _build_index(original_file)
+            finally:
+                original_file.close()
+            index = '\n'.join(str(n) for n in [records, size] + offsets) + '\n'
+
+        zf = zipfile.ZipFile(self.filename, mode='a' if os.path.exists(self.filename) else 'w')
+        try:
+            if index is not None:
+                zf.writestr('index', index, compress_type=compression)
+
+            removed = list()
+            blocks = _BlockWriter(zf, set(namelist))
+            for record, lines in _split_deltas(deltas, removed):
+                blocks.add(record, lines)
+            zf.writestr('versions/' + name + '/blocks', blocks.close(), compress_type=compression)
+
+            removal_map = ''.join('%d\t%d\n' % r for r in removed)
+            removal_name = 'removals/' + hashlib.md5(removal_map).hexdigest()
+            if removal_name not in namelist:
+                zf.writestr(removal_name, removal_map, compress_type=compression)
+            zf.writestr('versions/' + name + '/removals', removal_name, compress_type=compression)
+            for stream, filename in streams:
+                zf.write(filename, 'versions/' + name + '/' + stream, compress_type=compression)
+            zf.writestr('versions/' + name + '/md5_checksum', checksum, compress_type=compression)
+        finally:
+            zf.close()
+
+    def open(self, name, original_file=None, reuse=False):
+        """Returns an iterator over the lines of the named version, rebuilt from the original file."""
+        if original_file is None:
+            original_file = self.original_file
+        if name not in self.versions():
+            raise StoreError('No such version: ' + name)
+        if isinstance(original_file, str) and not original_file.endswith('.qp'):
+            records, size, offsets = self.index()
+            if os.path.getsize(original_file) != size:
+                raise StoreError('The original file does not match the index of this store.')
+        return StoreVersion(self.filename, name, original_file, reuse)
+
+
+class StoreVersion():
+    """Reads a single version from a DeltaStore, the same way a DeltaFile in read mode does."""
+
+    def __init__(self, store_filename, name, original_file=None, reuse=False):
+        self.name = name
+        self.reuse = reuse
+        self.buffer = list()
+
+        if isinstance(original_file, str):
+            self.original_file = _open(original_file)
+        else:
+            self.original_file = original_file
+        self.records = open_records(self.original_file)
+
+        self.zf = zipfile.ZipFile(store_filename)
+        # The offsets of every BLOCK_RECORDS'th record, to seek over long runs of removed records. Only done when the
+        # original is a plain file of the size in the index.
+        index = self.zf.read('index').split('\n')
+        self.offsets = [int(line) for line in index[2:] if line != '']
+        self.seekable = isinstance(self.records, MappedRecordReader) and len(self.records.map) == int(index[1])
+        self.checksum = self.zf.read('versions/' + name + '/md5_checksum')
+        removal_name = self.zf.read('versions/' + name + '/removals')
+        self.removed = [tuple(int(n) for n in line.split('\t'))
+                        for line in self.zf.read(removal_name).split('\n') if line != '']
+        self.decoder = _RecordDecoder(self.zf, 'versions/' + name + '/')
+        self.reset()
+
+    def __iter__(self):
+        return self
+
+    def _read_blocks(self):
+        """Yields the delta lines of every kept record, one block at a time."""
+        for line in self.zf.read('versions/' + self.name + '/blocks').split('\n'):
+            if line == '':
+                continue
+            columns = [self.zf.read('blocks/' + digest).split('\n') for digest in line.split('\t')]
+            for i in xrange(len(columns[0]) - 1):
+                yield [column[i] for column in columns]
+
+    def reset(self):
+        if hasattr(self, 'deltas'):
+            self.records.reset()
+        self.deltas = self._read_blocks()
+        self.record = 0
+        self.next_removal = 0
+        self.buffer = list()
+        self.md5 = hashlib.md5()
+
+    def _skip_removed(self):
+        """Skips the records of the original that were removed from this version."""
+        while self.next_removal < len(self.removed) and self.removed[self.next_removal][0] == self.record:
+            target = self.record + self.removed[self.next_removal][1]
+            block = target // BLOCK_RECORDS
+            if block * BLOCK_RECORDS > self.record and block < len(self.offsets) and self.seekable:
+                self.records.seek(self.offsets[block])
+                self.record = block * BLOCK_RECORDS
+            self.records.skip(target - self.record)
+            self.record = target
+            self.next_removal += 1
+
+    def next(self):
+        if self.zf.fp is None:
+            raise IOError("Trying to iterate over closed files...")
+
+        while len(self.buffer) <= 0:
+            self._skip_removed()
+            deltas = next(self.deltas, None)
+            if deltas is None:
+                # End of File
+                if not self.md5.digest() == self.checksum:
+                    self.close()
+                    raise ChecksumError("Checksum did not match!")
+                if self.reuse:
+                    self.reset()
+                else:
+                    self.close()
+                raise StopIteration
+            original = self.records.next_record()
+            for position, delta in enumerate(deltas):
+                self.buffer.append(self.decoder.decode(position, original[position], delta))
+            self.record += 1
+            self.buffer.reverse()
+
+        nextline = self.buffer.pop()
+        self.md5.update(nextline)
+        return nextline
+
+    def readline(self):
+        return self.next()
+
+    def readlines(self):
+        return [line for line in self]
+
+    def close(self):
+        self.zf.close()
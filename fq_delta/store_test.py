@@ -0,0 +1,120 @@
+__author__ = 'averaart'
+"""Tests of DeltaStore. Run them from the root of the repository with: python -m unittest discover -s fq_delta -t . -p
+'*_test.py'"""
+
+# Batteries included
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+# Custom modules
+import store
+from fq_delta import create_delta
+from benchmark import generate_records, write_records
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.original = self.path('original.fastq')
+        self.records = list(generate_records(300, read_length=30))
+        write_records(self.records, self.original)
+        self.store = store.DeltaStore(self.path('original.store.zip'), self.original)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def write_version(self, name, records):
+        filename = self.path(name + '.fastq')
+        write_records(records, filename)
+        return filename
+
+    def read_version(self, name):
+        return list(self.store.open(name))
+
+    def lines(self, records):
+        return [line for record in records for line in record]
+
+    def test_add_processed(self):
+        trimmed = [(i, s[2:-5], c, q[2:-5]) for i, s, c, q in self.records]
+        filtered = [record for n, record in enumerate(self.records) if n % 3 != 1]
+        self.store.add_processed('trimmed', self.write_version('trimmed', trimmed), ('quality', 'trim'))
+        self.store.add_processed('filtered', self.write_version('filtered', filtered))
+        self.assertEqual(['filtered', 'trimmed'], self.store.versions())
+        self.assertEqual(self.lines(trimmed), self.read_version('trimmed'))
+        self.assertEqual(self.lines(filtered), self.read_version('filtered'))
+
+    def test_add(self):
+        masked = [(i, s[:10] + 'N' * 5 + s[15:], c, q) for i, s, c, q in self.records]
+        create_delta(self.original, self.write_version('masked', masked), self.path('masked.delta'))
+        self.store.add('masked', self.path('masked.delta.zip'))
+        self.assertEqual(self.lines(masked), self.read_version('masked'))
+        self.assertRaises(store.StoreError, self.store.add, 'masked', self.path('masked.delta.zip'))
+        self.assertRaises(store.StoreError, self.store.add, 'a/b', self.path('masked.delta.zip'))
+
+    def test_index(self):
+        self.store.add_processed('all', self.original)
+        records, size, offsets = self.store.index()
+        self.assertEqual(len(self.records), records)
+        self.assertEqual(os.path.getsize(self.original), size)
+        self.assertEqual([0], offsets)
+        self.assertRaises(store.StoreError, self.store.open, 'other')
+
+    def test_seek_over_removed(self):
+        # Small blocks, so the index has offsets to seek to within a few hundred records.
+        block_records = store.BLOCK_RECORDS
+        store.BLOCK_RECORDS = 16
+        try:
+            kept = self.records[:5] + self.records[100:110] + self.records[290:]
+            self.store.add_processed('kept', self.write_version('kept', kept))
+            version = self.store.open('kept')
+            self.assertTrue(version.seekable)
+            self.assertEqual(len(self.records) // 16 + 1, len(version.offsets))
+            self.assertEqual(self.lines(kept), list(version))
+        finally:
+            store.BLOCK_RECORDS = block_records
+
+    def test_dedup(self):
+        def stored(prefix):
+            zf = zipfile.ZipFile(self.store.filename)
+            try:
+                return sorted(name for name in zf.namelist() if name.startswith(prefix))
+            finally:
+                zf.close()
+
+        filtered = [record for n, record in enumerate(self.records) if n % 5 != 0]
+        self.store.add_processed('first', self.write_version('filtered', filtered))
+        blocks = stored('blocks/')
+        # The id and comment columns are the same, and so are the sequence and quality columns.
+        self.assertEqual(2, len(blocks))
+        # The same version again shares every block and the removal map.
+        self.store.add_processed('second', self.path('filtered.fastq'))
+        self.assertEqual(blocks, stored('blocks/'))
+        self.assertEqual(1, len(stored('removals/')))
+        # A masked read only adds its sequence column.
+        masked = list(filtered)
+        masked[0] = (masked[0][0], 'N' + masked[0][1][1:], masked[0][2], masked[0][3])
+        self.store.add_processed('masked', self.write_version('masked', masked))
+        self.assertEqual(3, len(stored('blocks/')))
+        self.assertEqual(1, len(stored('removals/')))
+        self.assertEqual(self.lines(filtered), self.read_version('second'))
+        self.assertEqual(self.lines(masked), self.read_version('masked'))
+
+    def test_checksum(self):
+        self.store.add_processed('all', self.original)
+        zf = zipfile.ZipFile(self.store.filename, 'a')
+        zf.writestr('versions/broken/md5_checksum', 'x' * 16)
+        for name in ('blocks', 'removals'):
+            zf.writestr('versions/broken/' + name, zf.read('versions/all/' + name))
+        zf.close()
+        self.assertRaises(store.ChecksumError, self.read_version, 'broken')
+
+
+if __name__ == '__main__':
+    unittest.main()
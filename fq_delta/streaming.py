@@ -0,0 +1,222 @@
+__author__ = 'averaart'
+"""This module lets an event loop, or any other code that mustn't block, create and rebuild delta files. The work runs
+in a thread pool, and StreamPipes carry the data between the loop and the workers: the loop feeds the original or
+processed data into a pipe as it arrives from its streams, and takes the rebuilt data out of a pipe as it is produced.
+The pipes don't depend on any particular event loop. A pipe calls its callback from the worker thread when there is
+something to read, which a loop can hand over to its own thread, e.g. with call_soon_threadsafe."""
+
+# Batteries included
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+# Custom modules
+from fq_delta import create_delta, rebuild_fastq
+
+
+# The number of bytes a StreamPipe holds by default before its writer has to wait for the reader.
+PIPE_SIZE = 4 << 20
+
+
+class StreamPipe():
+    """A file-like buffer between one thread that writes and one that reads. read and readline block until there is
+    enough data or the writer has closed the pipe; read_nowait never blocks. write blocks while maxsize bytes or more
+    wait to be read, unless maxsize is 0. A writer that mustn't block, like an event loop, checks full before it
+    writes, and waits for drained to be called instead. If given, callback is called after every write and after
+    close, and drained when a full pipe has room again. Both are called from the thread on the other side of the
+    pipe."""
+
+    def __init__(self, name='<stream>', callback=None, maxsize=PIPE_SIZE, drained=None):
+        self.name = name
+        self.callback = callback
+        self.maxsize = maxsize
+        self.drained = drained
+        # The chunks that were written, and how far the first one was read.
+        self.chunks = deque()
+        self.start = 0
+        self.pending = 0
+        self.eof = False
+        self.discarded = False
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def full(self):
+        """Returns True if a write would block."""
+        with self.condition:
+            return self._full()
+
+    def _full(self):
+        return 0 < self.maxsize <= self.pending and not self.discarded
+
+    def write(self, data):
+        if data == '':
+            return
+        with self.condition:
+            if self.eof:
+                raise ValueError('Write to a closed pipe.')
+            while self._full():
+                self.condition.wait()
+            if self.discarded:
+                return
+            self.chunks.append(data)
+            self.pending += len(data)
+            self.condition.notify_all()
+        if self.callback is not None:
+            self.callback()
+
+    def close(self):
+        """Ends the data. Readers get the rest of the data, and then an empty string."""
+        with self.condition:
+            self.eof = True
+            self.condition.notify_all()
+        if self.callback is not None:
+            self.callback()
+
+    def discard(self):
+        """Tells the writer that nothing more will be read: the data that is there is dropped, and so is anything
+        written later, so a writer never waits for a reader that stopped."""
+        with self.condition:
+            was_full = self._full()
+            self.discarded = True
+            self.chunks.clear()
+            self.start = 0
+            self.pending = 0
+            self.condition.notify_all()
+        if was_full and self.drained is not None:
+            self.drained()
+
+    def flush(self):
+        pass
+
+    def at_eof(self):
+        """Returns True if the pipe is closed and all data is read."""
+        with self.condition:
+            return self.eof and self.pending == 0
+
+    def _take(self, size):
+        """Takes up to size bytes, or everything if size is negative, from the buffered chunks. Returns the data, and
+        whether the pipe got room for the writer."""
+        was_full = self._full()
+        if size < 0 or size > self.pending:
+            size = self.pending
+        pieces = list()
+        chunks = self.chunks
+        while size > 0:
+            chunk = chunks[0]
+            end = min(len(chunk), self.start + size)
+            pieces.append(chunk[self.start:end])
+            size -= end - self.start
+            self.pending -= end - self.start
+            if end == len(chunk):
+                chunks.popleft()
+                self.start = 0
+            else:
+                self.start = end
+        if was_full and not self._full():
+            self.condition.notify_all()
+            return ''.join(pieces), True
+        return ''.join(pieces), False
+
+    def _line_end(self):
+        """Returns the number of bytes up to and including the first line end, or -1 if there is none yet."""
+        length = 0
+        start = self.start
+        for chunk in self.chunks:
+            end = chunk.find('\n', start)
+            if end != -1:
+                return length + end + 1 - start
+            length += len(chunk) - start
+            start = 0
+        return -1
+
+    def _read(self, size, wait):
+        with self.condition:
+            # A full pipe won't get more data before it is read, so reading can't wait for more than that.
+            while wait and not self.eof and (size < 0 or self.pending < size) and not self._full():
+                self.condition.wait()
+            data, drained = self._take(size)
+        if drained and self.drained is not None:
+            self.drained()
+        return data
+
+    def read(self, size=-1):
+        return self._read(size, True)
+
+    def read_nowait(self, size=-1):
+        """Returns the data that is there, up to size bytes, without waiting for more."""
+        return self._read(size, False)
+
+    def readline(self):
+        with self.condition:
+            while True:
+                end = self._line_end()
+                if end != -1 or self.eof or self._full():
+                    break
+                self.condition.wait()
+            data, drained = self._take(end)
+        if drained and self.drained is not None:
+            self.drained()
+        return data
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if line == '':
+            raise StopIteration
+        return line
+
+
+def _apply(pool, function, args, kwargs):
+    """Runs function in a thread of pool. Without a pool, the job gets a pool of its own that is closed right away, so
+    its threads end when the job does."""
+    if pool is not None:
+        return pool.apply_async(function, args, kwargs)
+    pool = ThreadPool(1)
+    try:
+        return pool.apply_async(function, args, kwargs)
+    finally:
+        pool.close()
+
+
+def _discard_after(function, pipes):
+    """Discards what is left in the input pipes once function returns, as it won't read them any further."""
+    def run(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            for pipe in pipes:
+                pipe.discard()
+    return run
+
+
+def _close_after(function, pipe):
+    def run(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            pipe.close()
+    return run
+
+
+def start_delta(original_file, processed_file, delta_filename, pool=None, **kwargs):
+    """Starts create_delta in a thread of pool (a multiprocessing.pool.ThreadPool, or a new pool of one thread that
+    closes when done). Either file can be a StreamPipe that is fed while the delta is created. Returns an AsyncResult;
+    its ready method can be polled, and get returns when the delta file is complete, or raises the error that stopped
+    it. The other keyword arguments are passed on to create_delta."""
+    kwargs['delta_filename'] = delta_filename
+    pipes = [f for f in (original_file, processed_file) if isinstance(f, StreamPipe)]
+    return _apply(pool, _discard_after(create_delta, pipes), (original_file, processed_file), kwargs)
+
+
+def start_rebuild(delta_filename, original_file, out=None, pool=None, callback=None, **kwargs):
+    """Starts rebuild_fastq in a thread of pool, like start_delta. The original file can be a StreamPipe that is fed
+    while rebuilding. The rebuilt file is written to out, or, if out is None, to a new StreamPipe that calls callback
+    when there is something to read, and is closed when rebuilding stops. Returns the AsyncResult and out."""
+    pipes = [original_file] if isinstance(original_file, StreamPipe) else []
+    function = _discard_after(rebuild_fastq, pipes)
+    if out is None:
+        out = StreamPipe('<rebuilt>', callback)
+        function = _close_after(function, out)
+    return _apply(pool, function, (delta_filename, original_file, out), kwargs), out
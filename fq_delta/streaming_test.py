@@ -0,0 +1,119 @@
+__author__ = 'averaart'
+"""Tests of the streaming helpers. Run them from the root of the repository with: python -m unittest discover -s
+fq_delta -t . -p '*_test.py'"""
+
+# Batteries included
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+# Custom modules
+import streaming
+from streaming import StreamPipe
+from benchmark import generate_records, write_records
+
+
+class StreamPipeTest(unittest.TestCase):
+
+    def test_read(self):
+        pipe = StreamPipe()
+        for data in ('ab', 'cd\nef', '\n', 'g'):
+            pipe.write(data)
+        self.assertEqual('abc', pipe.read(3))
+        self.assertEqual('d\n', pipe.readline())
+        self.assertEqual('ef\n', pipe.readline())
+        self.assertEqual('g', pipe.read_nowait())
+        self.assertEqual('', pipe.read_nowait())
+        pipe.write('hi')
+        pipe.close()
+        self.assertEqual(['hi'], list(pipe))
+        self.assertTrue(pipe.at_eof())
+        self.assertRaises(ValueError, pipe.write, 'x')
+
+    def test_backpressure(self):
+        drained = list()
+        pipe = StreamPipe(maxsize=4, drained=lambda: drained.append(pipe.pending))
+        pipe.write('abc')
+        self.assertFalse(pipe.full())
+        pipe.write('defg')
+        self.assertTrue(pipe.full())
+        writer = threading.Thread(target=pipe.write, args=('hij',))
+        writer.start()
+        writer.join(0.2)
+        # The writer waits until the pipe has room again.
+        self.assertTrue(writer.is_alive())
+        self.assertEqual(7, pipe.pending)
+        # A full pipe can't wait for more data than it holds.
+        self.assertEqual('abcdefg', pipe.read(100))
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        self.assertEqual([0], drained)
+        self.assertEqual('hij', pipe.read_nowait())
+
+    def test_discard(self):
+        pipe = StreamPipe(maxsize=2)
+        pipe.write('abc')
+        writer = threading.Thread(target=pipe.write, args=('def',))
+        writer.start()
+        pipe.discard()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        pipe.write('ghi')
+        self.assertEqual(0, pipe.pending)
+
+
+class StartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # Rebuilding extracts the delta file to the working directory.
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+        records = list(generate_records(500, read_length=50))
+        self.original = os.path.join(self.dir, 'original.fastq')
+        write_records(records, self.original)
+        self.processed = os.path.join(self.dir, 'processed.fastq')
+        # Only the first half, so the original isn't read to the end.
+        write_records([(i, s[:-5], c, q[:-5]) for i, s, c, q in records[:250]], self.processed)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def feed(self, pipe, filename):
+        with open(filename) as f:
+            for data in iter(lambda: f.read(1000), ''):
+                pipe.write(data)
+        pipe.close()
+
+    def test_round_trip(self):
+        threads = threading.active_count()
+        delta = os.path.join(self.dir, 'processed.delta')
+        original = StreamPipe(maxsize=5000)
+        result = streaming.start_delta(original, self.processed, delta, codecs=('trim',))
+        # The writer isn't held up by the part of the original that is never read.
+        self.feed(original, self.original)
+        result.get(10)
+
+        original = StreamPipe(maxsize=5000)
+        result, out = streaming.start_rebuild(delta + '.zip', original)
+        feeder = threading.Thread(target=self.feed, args=(original, self.original))
+        feeder.start()
+        rebuilt = ''.join(out)
+        result.get(10)
+        feeder.join(10)
+        self.assertEqual(open(self.processed).read(), rebuilt)
+
+        # The threads of the pools end with their jobs.
+        for _ in xrange(50):
+            if threading.active_count() == threads:
+                break
+            time.sleep(0.1)
+        self.assertEqual(threads, threading.active_count())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,5 +15,6 @@ setup(name='fq_delta',
       packages=['fq_delta', 'diff_match_patch'],
       package_dir={'fq_delta': 'fq_delta'},
       package_data={'fq_delta': ['*.sh']},
-      scripts=['scripts/delta', 'scripts/rebuild', 'scripts/test_fq_delta']
+      scripts=['scripts/delta', 'scripts/rebuild', 'scripts/test_fq_delta', 'scripts/benchmark_fq_delta',
+               'scripts/fq_delta_server', 'scripts/delta-batch']
       )
\ No newline at end of file